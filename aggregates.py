@@ -0,0 +1,83 @@
+import copy
+from typing import Dict, Any, Optional
+
+from storage import Storage
+
+# Сводки обновляются при каждом сохранении результата, поэтому отчёт
+# учителя читает одну запись на ученика, а не всю историю результатов.
+#   student_stats[student_id] - попытки, баллы и последняя попытка ученика
+#   class_stats[class_id]     - попытки, баллы и число ошибок по вопросам тестов
+# Обновления идут в транзакции хранилища, чтобы параллельные результаты
+# одного класса не затирали друг друга.
+
+
+def _empty_student(student_id: str, class_id: Optional[str]) -> Dict[str, Any]:
+    return {'student_id': student_id, 'class_id': class_id, 'attempts': 0,
+            'correct': 0, 'total': 0, 'last_attempt': None}
+
+
+def _empty_class(class_id: str) -> Dict[str, Any]:
+    return {'class_id': class_id, 'attempts': 0, 'correct': 0, 'total': 0, 'errors': {}}
+
+
+def _apply(student_stats: Dict[str, Any], class_stats: Optional[Dict[str, Any]],
+           result: Dict[str, Any], topic: str):
+    for stats in (student_stats, class_stats):
+        if stats is not None:
+            stats['attempts'] += 1
+            stats['correct'] += result['correct_answers']
+            stats['total'] += result['total_questions']
+    student_stats['last_attempt'] = {
+        'test_id': result['test_id'],
+        'topic': topic,
+        'correct_answers': result['correct_answers'],
+        'total_questions': result['total_questions'],
+        'wrong_answers': result.get('wrong_answers', []),
+        'time': result.get('time')
+    }
+    if class_stats is not None:
+        errors = class_stats['errors'].setdefault(result['test_id'], {'topic': topic, 'questions': {}})
+        for error in result.get('wrong_answers', []):
+            errors['questions'][error['question']] = errors['questions'].get(error['question'], 0) + 1
+
+
+def record_result(store: Storage, result: Dict[str, Any], class_id: Optional[str], topic: str):
+    """Учитывает новый результат в сводках ученика и класса."""
+    with store.transaction():
+        student_id = result['student_id']
+        # Копии: при откате транзакции сводки в памяти не должны остаться изменёнными
+        student_stats = copy.deepcopy(store.get('student_stats', student_id)) or _empty_student(student_id, class_id)
+        student_stats['class_id'] = class_id
+        class_stats = None
+        if class_id is not None:
+            class_stats = copy.deepcopy(store.get('class_stats', class_id)) or _empty_class(class_id)
+        _apply(student_stats, class_stats, result, topic)
+        store.put('student_stats', student_id, student_stats)
+        if class_stats is not None:
+            store.put('class_stats', class_id, class_stats)
+
+
+def rebuild(store: Storage):
+    """Пересчитывает сводки по всем результатам (данные без сводок)."""
+    with store.transaction():
+        students: Dict[str, Dict[str, Any]] = {}
+        classes: Dict[str, Dict[str, Any]] = {}
+        topics: Dict[str, str] = {}
+        for result in store.values('results'):
+            student_id = result['student_id']
+            class_id = store.get('users', student_id, {}).get('class_id')
+            if result['test_id'] not in topics:
+                topics[result['test_id']] = store.get('tests', result['test_id'], {}).get('topic', 'Неизвестно')
+            student_stats = students.setdefault(student_id, _empty_student(student_id, class_id))
+            class_stats = classes.setdefault(class_id, _empty_class(class_id)) if class_id is not None else None
+            _apply(student_stats, class_stats, result, topics[result['test_id']])
+        for student_id, stats in students.items():
+            store.put('student_stats', student_id, stats)
+        for class_id, stats in classes.items():
+            store.put('class_stats', class_id, stats)
+        print(f"Сводки результатов пересчитаны: учеников {len(students)}, классов {len(classes)}")
+
+
+def ensure_aggregates(store: Storage):
+    if store.count('results') and not store.count('student_stats'):
+        rebuild(store)
@@ -0,0 +1,78 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import Future
+from typing import Optional
+
+import aiohttp
+
+
+class AsyncRuntime:
+    """
+    Один долгоживущий цикл событий в фоновом потоке и общая сессия aiohttp
+    с пулом соединений. Синхронные обработчики бота отправляют в него
+    корутины через submit() и получают concurrent.futures.Future.
+    """
+
+    def __init__(self, limit: int = 20, limit_per_host: int = 10, keepalive_timeout: float = 60):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name='async-runtime', daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro) -> Future:
+        """Запускает корутину в общем цикле событий."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """Общая сессия; вызывается только из корутин, работающих в этом цикле."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def _shutdown(self):
+        # Фоновые задачи (обработчики очередей и т.п.) отменяем до остановки цикла
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        try:
+            self.submit(self._shutdown()).result(timeout=5)
+        except Exception as e:
+            print(f"Ошибка при закрытии HTTP-сессии: {str(e)}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self._thread = None
+
+
+runtime = AsyncRuntime(
+    limit=int(os.getenv('LLM_POOL_LIMIT', '20')),
+    limit_per_host=int(os.getenv('LLM_POOL_LIMIT_PER_HOST', '10')),
+    keepalive_timeout=float(os.getenv('LLM_KEEPALIVE_TIMEOUT', '60'))
+)
@@ -0,0 +1,368 @@
+"""
+Нагрузочный тест бота без сети: обработчики simple_bor.py прогоняются на
+синтетических обновлениях от N учителей и M учеников (регистрация,
+создание и назначение теста, прохождение, отчёты). Вместо Yandex GPT и
+Telegram API работает локальный сервер-заглушка с настраиваемой задержкой
+и долей ошибок. Для каждого размера файла данных печатает p50/p95/p99
+задержки обработки, пропускную способность, время загрузки и сохранения
+данных и пиковое потребление памяти.
+
+    python benchmark.py --sizes 0,5000,50000 --teachers 5 --students 30
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, List
+
+from aiohttp import web
+
+BOT_TOKEN = '123456:benchmark'
+
+
+# --- Заглушка Yandex GPT и Telegram API ---
+
+def fake_questions(prompt: str) -> List[Dict[str, Any]]:
+    match = re.search(r'Количество вопросов: (\d+)', prompt)
+    count = int(match.group(1)) if match else 5
+    salt = random.randrange(10 ** 9)
+    return [{
+        'question': f'Синтетический вопрос {salt} номер {i} про {random.randrange(10 ** 6)}?',
+        'options': [f'вариант {salt}-{i}-{j}' for j in range(4)],
+        'correct': random.randrange(4),
+        'explanation': 'Потому что так задумано.'
+    } for i in range(count)]
+
+
+def completion_chunk(text: str, prompt: str = '', status: str = 'ALTERNATIVE_STATUS_FINAL') -> Dict[str, Any]:
+    # Токены считаются грубо, примерно по 4 символа на токен
+    usage = {'inputTextTokens': str(len(prompt) // 4), 'completionTokens': str(len(text) // 4),
+             'totalTokens': str((len(prompt) + len(text)) // 4)}
+    return {'result': {'alternatives': [{'message': {'role': 'assistant', 'text': text},
+                                         'status': status}], 'usage': usage}}
+
+
+def make_stub_app(latency: float, failure_rate: float) -> web.Application:
+    message_ids = itertools.count(1)
+
+    async def completion(request: web.Request):
+        data = await request.json()
+        await asyncio.sleep(random.uniform(0.5, 1.5) * latency)
+        if random.random() < failure_rate:
+            return web.Response(status=random.choice([429, 500, 503]), headers={'Retry-After': '0.2'})
+        prompt = data['messages'][-1]['text']
+        if 'Сгенерируй тест' not in prompt:
+            return web.json_response(completion_chunk('Хорошая попытка! Подумай ещё раз над условием.', prompt))
+        text = json.dumps({'questions': fake_questions(prompt)}, ensure_ascii=False)
+        # Как настоящая модель, обрезаем ответ по maxTokens
+        limit = int(data['completionOptions'].get('maxTokens', 2000)) * 4
+        status = 'ALTERNATIVE_STATUS_FINAL'
+        if len(text) > limit:
+            text, status = text[:limit], 'ALTERNATIVE_STATUS_TRUNCATED_FINAL'
+        if not data['completionOptions'].get('stream'):
+            return web.json_response(completion_chunk(text, prompt, status))
+        response = web.StreamResponse()
+        await response.prepare(request)
+        step = max(1, len(text) // 8)
+        for end in list(range(step, len(text), step)) + [len(text)]:
+            chunk = completion_chunk(text[:end], prompt, status if end == len(text) else 'ALTERNATIVE_STATUS_PARTIAL')
+            await response.write(json.dumps(chunk, ensure_ascii=False).encode() + b'\n')
+            await asyncio.sleep(latency / 8)
+        await response.write_eof()
+        return response
+
+    async def telegram(request: web.Request):
+        params = dict(request.query)
+        if request.can_read_body:
+            if request.content_type == 'application/json':
+                params.update(await request.json())
+            else:
+                params.update(await request.post())
+        method = request.match_info['method']
+        if method in ('sendMessage', 'editMessageText', 'sendDocument'):
+            chat_id = int(params.get('chat_id', 0))
+            result = {'message_id': next(message_ids), 'date': int(time.time()),
+                      'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', '')}
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    # telebot передаёт параметры в строке запроса, а текст сообщения бывает до 4096 символов
+    app = web.Application(handler_args={'max_line_size': 65536, 'max_field_size': 65536})
+    app.router.add_post('/completion', completion)
+    app.router.add_route('*', '/bot{token}/{method}', telegram)
+    return app
+
+
+def run_stub_server(port: int, latency: float, failure_rate: float):
+    web.run_app(make_stub_app(latency, failure_rate), host='127.0.0.1', port=port, print=None)
+
+
+# --- Синтетический файл данных ---
+
+def make_dataset(path: str, size: int, questions: int):
+    """Файл в формате bot_data.json примерно с size результатами."""
+    data = {'users': {}, 'classes': {}, 'tests': {}, 'results': {}}
+    teachers = max(1, size // 500)
+    classes = max(1, size // 250)
+    students = max(1, size // 10)
+    tests = max(1, size // 50)
+    for t in range(teachers):
+        data['users'][f'9{t:08d}'] = {'role': 'teacher', 'username': f'teacher{t}'}
+    for c in range(classes):
+        data['classes'][str(c + 1)] = {'id': str(c + 1), 'name': f'Архив {c}', 'teacher_id': f'9{c % teachers:08d}',
+                                       'students': [], 'access_code': f'A{c:05d}'}
+    for s in range(students):
+        class_id = str(s % classes + 1)
+        data['users'][f'8{s:08d}'] = {'role': 'student', 'username': f'student{s}', 'class_id': class_id}
+        data['classes'][class_id]['students'].append(f'8{s:08d}')
+    for t in range(tests):
+        data['tests'][str(t + 1)] = {'id': str(t + 1), 'topic': f'Архивная тема {t}', 'difficulty': 'средний',
+                                     'questions': fake_questions(f'Количество вопросов: {questions}'),
+                                     'teacher_id': f'9{t % teachers:08d}', 'class_id': str(t % classes + 1)}
+    for r in range(size):
+        test_id = str(r % tests + 1)
+        wrong = [{'question': data['tests'][test_id]['questions'][0]['question'], 'user_answer': 'a',
+                  'correct_answer': 'b', 'correct_index': 1}] if r % 3 == 0 else []
+        data['results'][str(r + 1)] = {
+            'id': str(r + 1), 'student_id': f'8{r % students:08d}', 'student_name': f'student{r % students}',
+            'test_id': test_id, 'correct_answers': questions - len(wrong), 'total_questions': questions,
+            'wrong_answers': wrong, 'teacher_id': data['tests'][test_id]['teacher_id'], 'time': time.time()
+        }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+
+
+# --- Прогон сценария (в отдельном процессе на каждый размер данных) ---
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(p / 100 * (len(ordered) - 1)))]
+
+
+class Driver:
+    """Подаёт обновления боту и измеряет время от поступления до конца обработки."""
+
+    def __init__(self, sb):
+        self.sb = sb
+        self.update_ids = itertools.count(1)
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.phase_time: Dict[str, float] = {}
+        self._submitted = 0
+        self._done = 0
+        self._cond = threading.Condition()
+        self._process = sb.bot._process
+        sb.bot._process = self._timed
+
+    def _timed(self, user_id, update):
+        try:
+            self._process(user_id, update)
+        finally:
+            with self._cond:
+                self.latencies[update.phase].append(time.perf_counter() - update.enqueued)
+                self._done += 1
+                self._cond.notify_all()
+
+    def _submit(self, phase: str, update):
+        update.phase = phase
+        update.enqueued = time.perf_counter()
+        with self._cond:
+            self._submitted += 1
+        self.sb.bot.process_new_updates([update])
+
+    def message(self, phase: str, user: int, text: str):
+        from telebot import types
+        d = {'update_id': next(self.update_ids), 'message': {
+            'message_id': next(self.update_ids), 'date': int(time.time()),
+            'chat': {'id': user, 'type': 'private'},
+            'from': {'id': user, 'is_bot': False, 'first_name': f'U{user}'}, 'text': text}}
+        if text.startswith('/'):
+            d['message']['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        self._submit(phase, types.Update.de_json(d))
+
+    def callback(self, phase: str, user: int, data: str):
+        from telebot import types
+        d = {'update_id': next(self.update_ids), 'callback_query': {
+            'id': str(next(self.update_ids)), 'chat_instance': 'bench', 'data': data,
+            'from': {'id': user, 'is_bot': False, 'first_name': f'U{user}'},
+            'message': {'message_id': 1, 'date': int(time.time()), 'chat': {'id': user, 'type': 'private'}, 'text': '-'}}}
+        self._submit(phase, types.Update.de_json(d))
+
+    def run_phase(self, phase: str, scripts: Dict[int, List[Any]]):
+        """Сообщения разных пользователей перемежаются, как в реальном классе."""
+        started = time.perf_counter()
+        steps = list(scripts.items())
+        for i in range(max((len(s) for _, s in steps), default=0)):
+            for user, script in steps:
+                if i < len(script):
+                    kind, payload = script[i]
+                    (self.message if kind == 'msg' else self.callback)(phase, user, payload)
+        with self._cond:
+            self._cond.wait_for(lambda: self._done >= self._submitted)
+        self.phase_time[phase] = time.perf_counter() - started
+
+
+def run_scenario(args) -> Dict[str, Any]:
+    started = time.perf_counter()
+    import simple_bor as sb
+    load_time = time.perf_counter() - started
+    driver = Driver(sb)
+    teachers = [10 ** 6 + i for i in range(args.teachers)]
+    students = [2 * 10 ** 6 + i for i in range(args.students)]
+
+    driver.run_phase('registration', {t: [('msg', '/start'), ('cb', 'register_teacher'), ('msg', sb.ADMIN_CODE),
+                                          ('msg', 'Создать класс'), ('msg', f'Бенчмарк {t}')] for t in teachers})
+    tests_before = sb.store.count('tests')
+    driver.run_phase('test_creation', {t: [('msg', 'Создать тест'), ('msg', f'Тема {t}'),
+                                           ('msg', str(args.questions)), ('msg', 'средний')] for t in teachers})
+    generation_started = time.perf_counter()
+    while sb.store.count('tests') < tests_before + len(teachers) and \
+            time.perf_counter() - generation_started < args.generation_timeout:
+        time.sleep(0.05)
+    generation_time = time.perf_counter() - generation_started
+
+    classes = {t: sb.store.find_one('classes', teacher_id=str(t)) for t in teachers}
+    tests = {t: (sb.store.find('tests', teacher_id=str(t)) or [None])[-1] for t in teachers}
+    ready = [t for t in teachers if tests[t] is not None and classes[t] is not None]
+    driver.run_phase('assignment', {t: [('msg', 'Назначить тест'), ('msg', f"Тест ID: {tests[t]['id']} - x"),
+                                        ('msg', f"Класс: {classes[t]['name']}")] for t in ready})
+    student_scripts = {}
+    for i, s in enumerate(students):
+        if not ready:
+            break
+        teacher = ready[i % len(ready)]
+        test = tests[teacher]
+        student_scripts[s] = [('msg', '/start'), ('cb', 'register_student'), ('msg', classes[teacher]['access_code']),
+                              ('msg', 'Мои тесты'), ('msg', f"Тест ID: {test['id']} - x")] + \
+                             [('msg', str(random.randint(1, 4))) for _ in test['questions']]
+    driver.run_phase('test_taking', student_scripts)
+    reports = {t: [('msg', 'Просмотреть результаты'), ('msg', f"Класс: {classes[t]['name']}"),
+                   ('msg', 'Просмотреть тесты')] for t in ready}
+    reports.update({s: [('msg', 'Мои результаты')] for s in students})
+    driver.run_phase('reports', reports)
+
+    # После close() SQLite-хранилище уже не читается
+    tests_generated = sb.store.count('tests') - tests_before
+    started = time.perf_counter()
+    sb.store.close()
+    save_time = time.perf_counter() - started
+    phases = {}
+    for phase, values in driver.latencies.items():
+        phases[phase] = {
+            'updates': len(values),
+            'p50_ms': percentile(values, 50) * 1000,
+            'p95_ms': percentile(values, 95) * 1000,
+            'p99_ms': percentile(values, 99) * 1000,
+            'throughput': len(values) / driver.phase_time[phase] if driver.phase_time[phase] else 0.0
+        }
+    return {
+        'size': args.size,
+        'load_s': load_time,
+        'save_s': save_time,
+        'generation_s': generation_time,
+        'tests_generated': tests_generated,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'phases': phases
+    }
+
+
+def child_main(args):
+    from telebot import apihelper
+    apihelper.API_URL = f'http://127.0.0.1:{args.port}/bot{{0}}/{{1}}'
+    if os.getenv('STORAGE_BACKEND') == 'sqlite':
+        from storage import SqliteStorage, read_snapshot
+        sqlite = SqliteStorage(os.environ['SQLITE_FILE']).open()
+        sqlite.import_data(read_snapshot(os.environ['DATA_FILE']))
+        sqlite.close()
+    result = run_scenario(args)
+    print('RESULT ' + json.dumps(result), flush=True)
+    # Фоновые подсказки и прочие задачи не дожидаемся
+    os._exit(0)
+
+
+def print_report(result: Dict[str, Any]):
+    print(f"\nРазмер данных: {result['size']} результатов | загрузка {result['load_s']:.2f} с, "
+          f"сохранение {result['save_s']:.2f} с, генерация тестов {result['generation_s']:.2f} с "
+          f"({result['tests_generated']} шт.), пик памяти {result['peak_rss_mb']:.0f} МБ")
+    print(f"{'этап':<14}{'обновлений':>11}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'обн/с':>10}")
+    for phase, stats in result['phases'].items():
+        print(f"{phase:<14}{stats['updates']:>11}{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}"
+              f"{stats['p99_ms']:>10.1f}{stats['throughput']:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест бота с заглушками LLM и Telegram')
+    parser.add_argument('--sizes', default='0,5000', help='размеры файла данных (число результатов) через запятую')
+    parser.add_argument('--teachers', type=int, default=5)
+    parser.add_argument('--students', type=int, default=30)
+    parser.add_argument('--questions', type=int, default=5, help='вопросов в создаваемом тесте')
+    parser.add_argument('--llm-latency', type=float, default=0.3, help='средняя задержка ответа LLM, с')
+    parser.add_argument('--llm-failure-rate', type=float, default=0.0, help='доля ответов 429/5xx')
+    parser.add_argument('--real-limits', action='store_true',
+                        help='оставить лимиты исходящих сообщений Telegram (иначе сняты)')
+    parser.add_argument('--generation-timeout', type=float, default=120)
+    parser.add_argument('--port', type=int, default=18090)
+    parser.add_argument('--cassette', help='файл записи ответов LLM (JSON Lines)')
+    parser.add_argument('--cassette-mode', choices=('record', 'replay'), default='record',
+                        help='записать ответы заглушки или воспроизвести их без обращения к ней')
+    parser.add_argument('--json', action='store_true', help='вывести результаты в JSON')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--size', type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child_main(args)
+        return
+
+    server = multiprocessing.Process(target=run_stub_server, daemon=True,
+                                     args=(args.port, args.llm_latency, args.llm_failure_rate))
+    server.start()
+    time.sleep(1)
+    results = []
+    try:
+        for size in [int(s) for s in args.sizes.split(',')]:
+            workdir = tempfile.mkdtemp(prefix='bench-')
+            env = dict(os.environ,
+                       BOT_TOKEN=BOT_TOKEN,
+                       YANDEX_API_KEY='bench', YANDEX_FOLDER_ID='bench',
+                       LLM_STUB_URL=f'http://127.0.0.1:{args.port}/completion', LLM_ROUTES='*=stub',
+                       DATA_FILE=os.path.join(workdir, 'bot_data.json'),
+                       SQLITE_FILE=os.path.join(workdir, 'bot_data.sqlite3'),
+                       TEST_CACHE_FILE=os.path.join(workdir, 'test_cache.json'))
+            if not args.real_limits:
+                env.update(TG_GLOBAL_RPS='100000', TG_CHAT_RPS='100000', TG_CHAT_BURST='100000')
+            if args.cassette:
+                env.update(LLM_CASSETTE=os.path.abspath(args.cassette), LLM_CASSETTE_MODE=args.cassette_mode)
+            make_dataset(env['DATA_FILE'], size, args.questions)
+            command = [sys.executable, os.path.abspath(__file__), '--child', '--size', str(size),
+                       '--port', str(args.port), '--teachers', str(args.teachers), '--students', str(args.students),
+                       '--questions', str(args.questions), '--generation-timeout', str(args.generation_timeout)]
+            output = subprocess.run(command, env=env, cwd=workdir, capture_output=True, text=True).stdout
+            lines = [line for line in output.splitlines() if line.startswith('RESULT ')]
+            if not lines:
+                print(f"Прогон для размера {size} завершился без результата:\n{output[-2000:]}")
+                continue
+            result = json.loads(lines[-1][len('RESULT '):])
+            results.append(result)
+            if not args.json:
+                print_report(result)
+    finally:
+        server.terminate()
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
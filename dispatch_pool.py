@@ -0,0 +1,122 @@
+import queue
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from outbound import RateLimitedTeleBot
+from metrics import registry
+
+UPDATE_SECONDS = registry.histogram('update_seconds', 'Обработка обновления целиком, по типу')
+
+_STOP = object()
+
+
+class KeyedExecutor:
+    """
+    Пул потоков с упорядочиванием по ключу. Ключ всегда попадает в один и
+    тот же поток, поэтому задачи одного пользователя выполняются строго по
+    очереди, а задачи разных пользователей - параллельно. Очередь каждого
+    потока ограничена: при переполнении submit() ждёт или возвращает False.
+    """
+
+    def __init__(self, workers: int = 8, queue_size: int = 100):
+        self._queues: List[queue.Queue] = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._threads = [
+            threading.Thread(target=self._worker, args=(q,), name=f'dispatch-{i}', daemon=True)
+            for i, q in enumerate(self._queues)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, key: Any, fn: Callable, *args, block: bool = True, timeout: Optional[float] = None) -> bool:
+        q = self._queues[hash(key) % len(self._queues)]
+        try:
+            q.put((fn, args), block=block, timeout=timeout)
+        except queue.Full:
+            return False
+        return True
+
+    def _worker(self, q: queue.Queue):
+        while True:
+            task = q.get()
+            if task is _STOP:
+                return
+            fn, args = task
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"Ошибка в обработчике: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        sizes = [q.qsize() for q in self._queues]
+        return {'workers': len(sizes), 'queued': sum(sizes), 'max_queue': max(sizes), 'queues': sizes}
+
+    def stop(self, timeout: float = 5):
+        """Дорабатывает уже принятые задачи и останавливает потоки."""
+        for q in self._queues:
+            q.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+
+
+def update_user_id(update) -> Optional[int]:
+    for kind in ('message', 'edited_message', 'callback_query', 'inline_query',
+                 'chosen_inline_result', 'poll_answer', 'my_chat_member', 'chat_member'):
+        event = getattr(update, kind, None)
+        if event is not None:
+            user = getattr(event, 'from_user', None) or getattr(event, 'user', None)
+            if user is not None:
+                return user.id
+    return None
+
+
+class PooledTeleBot(RateLimitedTeleBot):
+    """
+    TeleBot, который раскладывает обновления по KeyedExecutor с ключом
+    user_id. Сами обработчики выполняются в потоке пула (threaded=False),
+    поэтому ответы одного ученика обрабатываются в порядке поступления.
+    Исходящие сообщения ограничиваются RateLimitedTeleBot.
+    """
+
+    def __init__(self, token: str, workers: int = 8, queue_size: int = 100, **kwargs):
+        self._last_update_id = 0
+        self._update_id_lock = threading.Lock()
+        super().__init__(token, threaded=False, **kwargs)
+        self.pool = KeyedExecutor(workers, queue_size)
+        self._after_update: List[Callable[[str], None]] = []
+
+    @property
+    def last_update_id(self) -> int:
+        return self._last_update_id
+
+    @last_update_id.setter
+    def last_update_id(self, value: int):
+        # TeleBot сравнивает и присваивает без блокировки из потоков пула;
+        # уменьшение привело бы к повторной выдаче обновлений getUpdates
+        with self._update_id_lock:
+            if value > self._last_update_id:
+                self._last_update_id = value
+
+    def after_update(self, fn: Callable[[str], None]):
+        """Регистрирует fn(user_id), вызываемую после обработки каждого обновления."""
+        self._after_update.append(fn)
+        return fn
+
+    def _process(self, user_id: Optional[int], update):
+        kind = next((k for k in ('message', 'callback_query') if getattr(update, k, None) is not None), 'other')
+        with UPDATE_SECONDS.time(kind=kind):
+            super().process_new_updates([update])
+        if user_id is not None:
+            for fn in self._after_update:
+                fn(str(user_id))
+
+    def submit_update(self, update, block: bool = True) -> bool:
+        user_id = update_user_id(update)
+        key = user_id if user_id is not None else update.update_id
+        return self.pool.submit(key, self._process, user_id, update, block=block)
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            # Смещение для следующего getUpdates сдвигается сразу, а не после
+            # обработки в пуле, иначе ещё не обработанные обновления придут снова
+            self.last_update_id = update.update_id
+            self.submit_update(update)
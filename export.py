@@ -0,0 +1,116 @@
+import csv
+import os
+import tempfile
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from storage import Storage
+
+try:
+    import xlsxwriter
+except ImportError:  # XLSX недоступен, остаётся CSV
+    xlsxwriter = None
+
+FORMATS = ('csv', 'xlsx') if xlsxwriter is not None else ('csv',)
+
+HEADER = ['Ученик', 'Класс', 'ID теста', 'Тема', 'Дата', 'Правильно', 'Всего', '%']
+
+
+def iter_class_results(store: Storage, class_id: str) -> Iterator[Dict[str, Any]]:
+    for student_id, _ in store.find_items('users', class_id=class_id):
+        yield from store.iter_find('results', student_id=student_id)
+
+
+def iter_teacher_results(store: Storage, teacher_id: str) -> Iterator[Dict[str, Any]]:
+    return store.iter_find('results', teacher_id=teacher_id)
+
+
+class RowBuilder:
+    """
+    Превращает результаты в строки таблицы. Держит в памяти только
+    справочники тестов и классов, сами результаты не накапливаются.
+    """
+
+    def __init__(self, store: Storage, question_columns: int):
+        self.store = store
+        self.question_columns = question_columns
+        self._tests: Dict[str, Optional[Dict[str, Any]]] = {}
+        self._class_names: Dict[str, str] = {}
+
+    def header(self) -> List[str]:
+        return HEADER + [f'В{i + 1}' for i in range(self.question_columns)]
+
+    def _test(self, test_id: str) -> Optional[Dict[str, Any]]:
+        if test_id not in self._tests:
+            test = self.store.get('tests', test_id)
+            self._tests[test_id] = test and {'topic': test['topic'], 'questions': [
+                (q['question'], q['correct']) for q in test['questions']]}
+        return self._tests[test_id]
+
+    def _class_name(self, student_id: str) -> str:
+        class_id = self.store.get('users', student_id, {}).get('class_id') or ''
+        if class_id not in self._class_names:
+            self._class_names[class_id] = self.store.get('classes', class_id, {}).get('name', '')
+        return self._class_names[class_id]
+
+    def correctness(self, result: Dict[str, Any], test: Optional[Dict[str, Any]]) -> List[Any]:
+        """1/0 по каждому вопросу; пусто, если восстановить нельзя."""
+        if test is None:
+            return []
+        answers = result.get('answers')
+        if answers is not None:
+            return [int(i < len(answers) and answers[i] == correct) for i, (_, correct) in enumerate(test['questions'])]
+        # Старые результаты хранят только тексты вопросов с ошибками
+        wrong = {error['question'] for error in result.get('wrong_answers', [])}
+        return [int(question not in wrong) for question, _ in test['questions']]
+
+    def row(self, result: Dict[str, Any]) -> List[Any]:
+        test = self._test(result['test_id'])
+        total = result['total_questions']
+        when = datetime.fromtimestamp(result['time']).strftime('%Y-%m-%d %H:%M') if result.get('time') else ''
+        row = [result.get('student_name', ''), self._class_name(result['student_id']), result['test_id'],
+               test['topic'] if test else '', when, result['correct_answers'], total,
+               round(100 * result['correct_answers'] / total) if total else 0]
+        cells = self.correctness(result, test)[:self.question_columns]
+        return row + cells + [''] * (self.question_columns - len(cells))
+
+
+def write_csv(path: str, header: List[str], rows: Iterable[List[Any]]) -> int:
+    count = 0
+    # utf-8-sig и ';' - чтобы Excel с русской локалью открыл файл без мастера импорта
+    with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f, delimiter=';')
+        writer.writerow(header)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def write_xlsx(path: str, header: List[str], rows: Iterable[List[Any]]) -> int:
+    # constant_memory: каждая строка сбрасывается на диск сразу после записи
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+    sheet = workbook.add_worksheet('Результаты')
+    bold = workbook.add_format({'bold': True})
+    sheet.write_row(0, 0, header, bold)
+    count = 0
+    for row in rows:
+        count += 1
+        sheet.write_row(count, 0, row)
+    workbook.close()
+    return count
+
+
+def export_results(store: Storage, results: Iterable[Dict[str, Any]], fmt: str,
+                   question_columns: int) -> Tuple[str, int]:
+    """Пишет результаты во временный файл и возвращает (путь, число строк)."""
+    builder = RowBuilder(store, question_columns)
+    fd, path = tempfile.mkstemp(prefix='results-', suffix=f'.{fmt}')
+    os.close(fd)
+    writer = write_xlsx if fmt == 'xlsx' else write_csv
+    try:
+        count = writer(path, builder.header(), (builder.row(result) for result in results))
+    except Exception:
+        os.remove(path)
+        raise
+    return path, count
@@ -0,0 +1,99 @@
+import copy
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, List
+
+from storage import write_snapshot
+
+
+def normalize_topic(topic: str) -> str:
+    """Приводит тему к каноническому виду: регистр, ё, пунктуация, пробелы."""
+    topic = topic.lower().replace('ё', 'е')
+    topic = re.sub(r'[^\w\s]', ' ', topic)
+    return ' '.join(topic.split())
+
+
+class GeneratedTestCache:
+    """
+    LRU-кэш сгенерированных тестов с ограничением времени жизни.
+    Ключ - нормализованные (тема, количество вопросов, сложность).
+    Содержимое сохраняется в файл и переживает перезапуск бота.
+    """
+
+    def __init__(self, path: str, max_entries: int = 200, ttl: float = 7 * 24 * 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._load()
+
+    @staticmethod
+    def make_key(topic: str, num_questions: int, difficulty: str) -> str:
+        return f"{normalize_topic(topic)}|{num_questions}|{difficulty.strip().lower()}"
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"Не удалось прочитать кэш тестов: {str(e)}")
+            return
+        now = time.time()
+        for key, entry in entries:
+            if now - entry['created'] < self.ttl:
+                self._entries[key] = entry
+
+    def _save(self):
+        write_snapshot(self.path, json.dumps(list(self._entries.items()), ensure_ascii=False))
+
+    def _lookup(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry['created'] >= self.ttl:
+            del self._entries[key]
+            return None
+        return entry
+
+    def contains(self, topic: str, num_questions: int, difficulty: str) -> bool:
+        """Проверка без влияния на статистику и порядок вытеснения."""
+        with self._lock:
+            return self._lookup(self.make_key(topic, num_questions, difficulty)) is not None
+
+    def get(self, topic: str, num_questions: int, difficulty: str) -> Optional[List[Dict[str, Any]]]:
+        key = self.make_key(topic, num_questions, difficulty)
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return copy.deepcopy(entry['questions'])
+
+    def put(self, topic: str, num_questions: int, difficulty: str, questions: List[Dict[str, Any]]):
+        key = self.make_key(topic, num_questions, difficulty)
+        with self._lock:
+            self._entries[key] = {'created': time.time(), 'questions': questions}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._save()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
@@ -0,0 +1,124 @@
+import asyncio
+from typing import AsyncIterator, Dict, Any, List, Optional, Tuple
+
+from llm_scheduler import INTERACTIVE, BACKGROUND
+from storage import Storage
+from yagpt import generate_hint
+
+
+class HintCache:
+    """
+    Подсказки для каждого неверного варианта ответа. После создания теста
+    все подсказки генерируются в фоне и сохраняются в самом тесте
+    (test['hints'][номер вопроса][номер варианта]), поэтому во время
+    прохождения теста они выдаются без обращения к LLM. То, что ещё не
+    готово, генерируется по запросу и запоминается.
+    """
+
+    def __init__(self, store: Storage, api_key: str, folder_id: str):
+        self.store = store
+        self.api_key = api_key
+        self.folder_id = folder_id
+        self._memo: Dict[Tuple[str, int, int], str] = {}
+        self._inflight: Dict[Tuple[str, int, int], asyncio.Future] = {}
+        self._tasks = set()
+
+    def cached(self, test: Dict[str, Any], question_index: int, option_index: int) -> Optional[str]:
+        """Готовая подсказка или None; не обращается к LLM."""
+        hint = test.get('hints', {}).get(str(question_index), {}).get(str(option_index))
+        return hint or self._memo.get((test['id'], question_index, option_index))
+
+    async def get(self, test: Dict[str, Any], question_index: int, option_index: int,
+                  persist: bool = True, priority: int = INTERACTIVE) -> Optional[str]:
+        hint = self.cached(test, question_index, option_index)
+        if hint:
+            return hint
+        key = (test['id'], question_index, option_index)
+        # Одновременные запросы одной и той же подсказки ждут один вызов LLM
+        if key in self._inflight:
+            return await asyncio.shield(self._inflight[key])
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        hint = None
+        try:
+            hint = await self._generate(test, question_index, option_index, priority)
+            if hint:
+                self._memo[key] = hint
+                if persist:
+                    await self._save_async(test['id'], {str(question_index): {str(option_index): hint}})
+        except Exception as e:
+            print(f"Ошибка генерации подсказки: {str(e)}")
+        finally:
+            future.set_result(hint)
+            del self._inflight[key]
+        return hint
+
+    async def _generate(self, test: Dict[str, Any], question_index: int, option_index: int,
+                        priority: int) -> Optional[str]:
+        # Частоту и число одновременных запросов ограничивает llm_scheduler
+        question = test['questions'][question_index]
+        return await generate_hint(question['question'], question['options'][option_index],
+                                   self.api_key, self.folder_id, priority=priority)
+
+    async def get_many(self, test: Dict[str, Any], pairs: List[Tuple[int, int]],
+                       concurrency: int) -> AsyncIterator[Tuple[int, Optional[str]]]:
+        """
+        Подсказки к нескольким парам (вопрос, вариант): запросы идут
+        параллельно, не больше concurrency сразу, а результаты отдаются
+        как (номер пары, подсказка) по мере готовности.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(index: int, question_index: int, option_index: int):
+            async with semaphore:
+                return index, await self.get(test, question_index, option_index)
+
+        for done in asyncio.as_completed([one(i, qi, oi) for i, (qi, oi) in enumerate(pairs)]):
+            yield await done
+
+    def _save(self, test_id: str, hints: Dict[str, Dict[str, str]]):
+        """Дописывает подсказки в тест и убирает их из памяти."""
+        with self.store.transaction():
+            test = self.store.get('tests', test_id)
+            if test is None:
+                return
+            saved = {index: dict(options) for index, options in test.get('hints', {}).items()}
+            for question_index, options in hints.items():
+                saved.setdefault(question_index, {}).update(options)
+            self.store.put('tests', test_id, dict(test, hints=saved))
+        for question_index, options in hints.items():
+            for option_index in options:
+                self._memo.pop((test_id, int(question_index), int(option_index)), None)
+
+    async def _save_async(self, test_id: str, hints: Dict[str, Dict[str, str]]):
+        # Транзакция может ждать блокировку хранилища - не в цикле событий
+        await asyncio.get_running_loop().run_in_executor(None, self._save, test_id, hints)
+
+    async def precompute(self, test_id: str):
+        """Генерирует подсказки для всех неверных вариантов теста."""
+        test = self.store.get('tests', test_id)
+        if test is None:
+            return
+        pairs = [
+            (question_index, option_index)
+            for question_index, question in enumerate(test['questions'])
+            for option_index in range(len(question['options']))
+            if option_index != question['correct']
+        ]
+        # Фоновый приоритет: подсказки по запросу учеников обгоняют предрасчёт
+        results = await asyncio.gather(*(self.get(test, qi, oi, persist=False, priority=BACKGROUND)
+                                         for qi, oi in pairs))
+        hints: Dict[str, Dict[str, str]] = {}
+        for (question_index, option_index), hint in zip(pairs, results):
+            if hint:
+                hints.setdefault(str(question_index), {})[str(option_index)] = hint
+        # Все подсказки теста записываются одним изменением
+        if hints:
+            await self._save_async(test_id, hints)
+        print(f"Подсказки для теста {test_id}: {sum(len(options) for options in hints.values())}/{len(pairs)}")
+
+    def schedule_precompute(self, test_id: str):
+        """Запускает precompute() в фоне; вызывается из общего цикла событий."""
+        task = asyncio.ensure_future(self.precompute(test_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
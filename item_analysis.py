@@ -0,0 +1,153 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from metrics import registry
+from storage import Storage
+
+# Вариант ответа неизвестен: старый результат без answers, где вопрос не нашёлся
+UNKNOWN = -1
+PERCENTILES = (25, 50, 75, 90)
+
+ITEM_ANALYSIS_SECONDS = registry.histogram('item_analysis_seconds', 'Построение и расчёт анализа заданий теста')
+
+
+class ResponseMatrix:
+    """
+    Ответы на один тест: строка - ученик (его последняя попытка), столбец -
+    вопрос, значение - номер выбранного варианта. Массив выделяется с
+    запасом, и новые результаты дописываются в него на месте.
+    """
+
+    def __init__(self, test: Dict[str, Any]):
+        questions = test['questions']
+        self.correct = np.array([q['correct'] for q in questions], dtype=np.int8)
+        self.options = [q['options'] for q in questions]
+        self.num_options = max((len(options) for options in self.options), default=0)
+        self._by_text = {q['question']: i for i, q in enumerate(questions)}
+        self.choices = np.full((16, len(questions)), UNKNOWN, dtype=np.int8)
+        self.rows: Dict[str, int] = {}    # student_id -> строка
+        # Класс ученика каждой строки - номером в class_ids
+        self.class_codes = np.zeros(16, dtype=np.int32)
+        self.class_ids: List[Optional[str]] = []
+        self.students = 0
+        self.attempts = 0
+
+    def _class_code(self, class_id: Optional[str]) -> int:
+        if class_id not in self.class_ids:
+            self.class_ids.append(class_id)
+        return self.class_ids.index(class_id)
+
+    def _choices_of(self, result: Dict[str, Any]) -> np.ndarray:
+        answers = result.get('answers')
+        if answers is not None:
+            row = np.full(len(self.correct), UNKNOWN, dtype=np.int8)
+            count = min(len(answers), len(row))
+            row[:count] = answers[:count]
+            return row
+        # Старые результаты хранят только ошибки: остальные ответы верные
+        row = self.correct.copy()
+        for error in result.get('wrong_answers', []):
+            i = self._by_text.get(error['question'])
+            if i is not None:
+                options = self.options[i]
+                row[i] = options.index(error['user_answer']) if error['user_answer'] in options else UNKNOWN
+        return row
+
+    def add(self, result: Dict[str, Any], class_id: Optional[str]):
+        row = self.rows.get(result['student_id'])
+        if row is None:
+            row = self.rows[result['student_id']] = self.students
+            self.students += 1
+            if row >= len(self.choices):
+                grown = np.full((2 * len(self.choices), self.choices.shape[1]), UNKNOWN, dtype=np.int8)
+                grown[:row] = self.choices[:row]
+                self.choices = grown
+                self.class_codes = np.resize(self.class_codes, len(grown))
+        self.class_codes[row] = self._class_code(class_id)
+        self.choices[row] = self._choices_of(result)
+        self.attempts += 1
+
+    def analyze(self) -> Optional[Dict[str, Any]]:
+        """
+        Показатели заданий: трудность (доля верных ответов), различающая
+        способность (точечно-бисериальная корреляция с баллом за остальные
+        вопросы), доли выбора каждого варианта и процентили баллов по классам.
+        """
+        students = self.students
+        if not students or not len(self.correct):
+            return None
+        choices = self.choices[:students]
+        scores = (choices == self.correct).astype(np.float64)
+        total = scores.sum(axis=1)
+        rest = total[:, None] - scores
+        scores_std, rest_std = scores.std(axis=0), rest.std(axis=0)
+        covariance = ((scores - scores.mean(axis=0)) * (rest - rest.mean(axis=0))).mean(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            discrimination = np.where((scores_std > 0) & (rest_std > 0), covariance / (scores_std * rest_std), np.nan)
+        frequency = (choices[:, :, None] == np.arange(self.num_options)).mean(axis=0)
+        percent = 100 * total / len(self.correct)
+        codes = self.class_codes[:students]
+        percentiles = {self.class_ids[code]: np.percentile(percent[codes == code], PERCENTILES)
+                       for code in np.unique(codes)}
+        return {
+            'students': students,
+            'attempts': self.attempts,
+            'mean_percent': float(percent.mean()),
+            'difficulty': scores.mean(axis=0),
+            'discrimination': discrimination,
+            'frequency': frequency,
+            'percentiles': percentiles,
+        }
+
+
+class ItemAnalytics:
+    """
+    Кэш матриц ответов по тестам. Матрица строится из результатов при
+    первом запросе анализа, затем дополняется каждым новым результатом
+    (record), поэтому повторный анализ не перечитывает историю. Хранится
+    не больше max_tests матриц, давно не запрошенные вытесняются.
+    """
+
+    def __init__(self, store: Storage, max_tests: int = 200):
+        self.store = store
+        self.max_tests = max_tests
+        self._matrices: 'OrderedDict[str, ResponseMatrix]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _class_id(self, student_id: str) -> Optional[str]:
+        return self.store.get('users', student_id, {}).get('class_id')
+
+    def _matrix(self, test_id: str) -> Optional[ResponseMatrix]:
+        matrix = self._matrices.get(test_id)
+        if matrix is not None:
+            self._matrices.move_to_end(test_id)
+            return matrix
+        test = self.store.get('tests', test_id)
+        if test is None:
+            return None
+        with ITEM_ANALYSIS_SECONDS.time(op='build'):
+            matrix = ResponseMatrix(test)
+            for result in self.store.iter_find('results', test_id=test_id):
+                matrix.add(result, self._class_id(result['student_id']))
+        self._matrices[test_id] = matrix
+        if len(self._matrices) > self.max_tests:
+            self._matrices.popitem(last=False)
+        return matrix
+
+    def record(self, result: Dict[str, Any], class_id: Optional[str]):
+        """Дописывает новый результат в матрицу, если она уже построена."""
+        with self._lock:
+            matrix = self._matrices.get(result['test_id'])
+            if matrix is not None:
+                matrix.add(result, class_id)
+
+    def analyze(self, test_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            matrix = self._matrix(test_id)
+            if matrix is None:
+                return None
+            with ITEM_ANALYSIS_SECONDS.time(op='analyze'):
+                return matrix.analyze()
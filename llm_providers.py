@@ -0,0 +1,381 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import aiohttp
+
+from async_runtime import runtime
+from llm_scheduler import scheduler, RetryableError, parse_retry_after, INTERACTIVE
+from metrics import registry
+
+# Адрес API Yandex GPT; локальная заглушка (benchmark.py) подключается через LLM_STUB_URL
+COMPLETION_URL = os.getenv('YANDEX_COMPLETION_URL', "https://llm.api.cloud.yandex.net/foundationModels/v1/completion")
+
+# Маршруты по умолчанию: для любого вида запроса сначала lite, при сбоях - полная модель
+DEFAULT_ROUTES = '*=yandex-lite,yandex-full'
+# Порог медленного ответа, с: у потоков - до первой части ответа, у
+# остальных запросов - до полного ответа, поэтому тест целиком получает больше
+DEFAULT_SLOW_SECONDS = '*=15;generate_test=40'
+
+LLM_REQUEST_SECONDS = registry.histogram('llm_request_seconds', 'Длительность HTTP-запроса к Yandex GPT')
+LLM_TOKENS = registry.counter('llm_tokens_total', 'Токены из usage ответов Yandex GPT')
+LLM_FALLBACKS = registry.counter('llm_fallbacks_total', 'Переключения на запасного провайдера LLM')
+
+OnText = Callable[[str], Awaitable[None]]
+
+
+class LLMError(Exception):
+    """Ответ API, который не имеет смысла повторять."""
+
+
+def record_usage(operation: str, usage: Optional[Dict[str, Any]]):
+    for field, kind in (('inputTextTokens', 'input'), ('completionTokens', 'completion')):
+        if usage and usage.get(field) is not None:
+            LLM_TOKENS.inc(int(usage[field]), operation=operation, kind=kind)
+
+
+def completion_alternative(result: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    alternatives = (result or {}).get('result', {}).get('alternatives') or [{}]
+    return alternatives[0]
+
+
+def completion_text(result: Optional[Dict[str, Any]]) -> str:
+    return completion_alternative(result).get('message', {}).get('text', "")
+
+
+def api_headers(api_key: str, folder_id: str) -> Dict[str, str]:
+    return {
+        "Authorization": f"Api-Key {api_key}",
+        "x-folder-id": folder_id,
+        "Content-Type": "application/json"
+    }
+
+
+class HttpProvider:
+    """
+    Модель за HTTP API completion Yandex GPT: lite, полная или заглушка с
+    тем же протоколом. Один вызов - один HTTP-запрос; временные ошибки
+    бросаются как RetryableError, повторяет их планировщик.
+    """
+
+    def __init__(self, name: str, url: str, model: str):
+        self.name = name
+        self.url = url
+        self.model = model
+
+    def _payload(self, data: Dict[str, Any], folder_id: str) -> Dict[str, Any]:
+        return dict(data, modelUri=f"gpt://{folder_id}/{self.model}")
+
+    async def complete(self, data: Dict[str, Any], api_key: str, folder_id: str, timeout: float,
+                       operation: str) -> Dict[str, Any]:
+        session = await runtime.get_session()
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            async with session.post(self.url, headers=api_headers(api_key, folder_id),
+                                    json=self._payload(data, folder_id),
+                                    timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+                status = str(resp.status)
+                if resp.status == 429 or resp.status >= 500:
+                    raise RetryableError(f"HTTP {resp.status}", parse_retry_after(resp.headers.get('Retry-After')))
+                if resp.status != 200:
+                    raise LLMError(f"HTTP {resp.status}")
+                result = await resp.json()
+                record_usage(operation, result.get('result', {}).get('usage'))
+                return result
+        except asyncio.TimeoutError as e:
+            status = 'timeout'
+            raise RetryableError(f"{type(e).__name__}: {str(e)}")
+        except aiohttp.ClientConnectionError as e:
+            raise RetryableError(f"{type(e).__name__}: {str(e)}")
+        finally:
+            LLM_REQUEST_SECONDS.observe(time.perf_counter() - started, operation=operation, status=status,
+                                        provider=self.name)
+
+    async def stream(self, data: Dict[str, Any], api_key: str, folder_id: str, on_text: OnText,
+                     timeout: float, operation: str) -> Dict[str, Any]:
+        session = await runtime.get_session()
+        last = {}
+        usage = None
+        started = False
+        request_started = time.perf_counter()
+        status = 'error'
+        try:
+            async with session.post(self.url, headers=api_headers(api_key, folder_id),
+                                    json=self._payload(data, folder_id),
+                                    timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+                status = str(resp.status)
+                if resp.status == 429 or resp.status >= 500:
+                    raise RetryableError(f"HTTP {resp.status}", parse_retry_after(resp.headers.get('Retry-After')))
+                if resp.status != 200:
+                    raise LLMError(f"HTTP {resp.status}")
+                async for line in resp.content:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    last = json.loads(line)
+                    usage = last.get('result', {}).get('usage') or usage
+                    started = True
+                    await on_text(completion_text(last))
+        except (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError) as e:
+            if isinstance(e, asyncio.TimeoutError):
+                status = 'timeout'
+            if started:
+                raise LLMError(f"Поток прерван: {type(e).__name__}")
+            raise RetryableError(f"{type(e).__name__}: {str(e)}")
+        finally:
+            LLM_REQUEST_SECONDS.observe(time.perf_counter() - request_started, operation=operation, status=status,
+                                        provider=self.name)
+        record_usage(operation, usage)
+        return last
+
+
+class RecordReplayProvider:
+    """
+    Запись и воспроизведение ответов LLM для воспроизводимых прогонов без
+    сети. С inner ответы настоящего провайдера дописываются в файл (JSON
+    Lines), без inner - выдаются из файла. Ключ - вид запроса и его тело;
+    модель в тело не входит (её подставляет провайдер), так что запись с
+    любой модели воспроизводится при любом маршруте. Одинаковые запросы
+    получают записанные ответы по очереди.
+    """
+
+    def __init__(self, path: str, inner: Optional[HttpProvider] = None):
+        self.path = path
+        self.inner = inner
+        self.name = inner.name if inner is not None else 'replay'
+        self._responses: Dict[str, List[Dict[str, Any]]] = {}
+        self._next: Dict[str, int] = {}
+        if inner is None:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._responses.setdefault(entry['key'], []).append(entry)
+
+    @staticmethod
+    def key(operation: str, data: Dict[str, Any]) -> str:
+        # maxTokens подстраивается под прошлые ответы и в ключ не входит
+        options = {k: v for k, v in data.get('completionOptions', {}).items() if k != 'maxTokens'}
+        body = dict(data, completionOptions=options)
+        return hashlib.sha256(json.dumps([operation, body], ensure_ascii=False, sort_keys=True)
+                              .encode('utf-8')).hexdigest()
+
+    def _replay(self, key: str, operation: str) -> Dict[str, Any]:
+        entries = self._responses.get(key)
+        if not entries:
+            raise LLMError(f"Нет записанного ответа для {operation}")
+        index = self._next.get(key, 0)
+        self._next[key] = index + 1
+        return entries[min(index, len(entries) - 1)]
+
+    def _record(self, entry: Dict[str, Any]):
+        # Все провайдеры пишут из общего цикла событий, строки не перемешиваются
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+    async def complete(self, data: Dict[str, Any], api_key: str, folder_id: str, timeout: float,
+                       operation: str) -> Dict[str, Any]:
+        key = self.key(operation, data)
+        if self.inner is None:
+            return self._replay(key, operation)['response']
+        response = await self.inner.complete(data, api_key, folder_id, timeout, operation)
+        self._record({'key': key, 'operation': operation, 'response': response})
+        return response
+
+    async def stream(self, data: Dict[str, Any], api_key: str, folder_id: str, on_text: OnText,
+                     timeout: float, operation: str) -> Dict[str, Any]:
+        key = self.key(operation, data)
+        if self.inner is None:
+            entry = self._replay(key, operation)
+            text = completion_text(entry['response'])
+            # Части потока воспроизводятся как начала итогового текста
+            for cut in entry.get('cuts', [len(text)]):
+                await on_text(text[:cut])
+            return entry['response']
+        cuts = []
+
+        async def recording(text: str):
+            cuts.append(len(text))
+            await on_text(text)
+
+        response = await self.inner.stream(data, api_key, folder_id, recording, timeout, operation)
+        self._record({'key': key, 'operation': operation, 'cuts': cuts, 'response': response})
+        return response
+
+
+class ProviderHealth:
+    """Скользящие средние задержки и доли ошибок провайдера для одного вида запросов."""
+
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.calls = 0
+        self.degraded_until = 0.0
+
+    def observe(self, seconds: float, ok: bool):
+        self.calls += 1
+        self.latency = seconds if self.latency is None else self.latency + self.alpha * (seconds - self.latency)
+        self.error_rate += self.alpha * ((0.0 if ok else 1.0) - self.error_rate)
+
+
+class LLMRouter:
+    """
+    Выбор провайдера для каждого вида запроса (operation). Маршрут -
+    список провайдеров в порядке предпочтения. Провайдер, у которого
+    средняя задержка выше порога slow_seconds для этого вида запроса
+    (у потоков считается задержка до первой части ответа) или доля
+    ошибок выше max_error_rate,
+    на cooldown секунд уходит в конец списка; затем он снова получает
+    запросы и либо восстанавливается, либо уходит опять. Если запрос к
+    провайдеру не удался, он повторяется у следующего; у всех, кроме
+    последнего, планировщик делает не больше fallback_retries повторов,
+    чтобы не ждать полный цикл повторов на сбойной модели.
+    """
+
+    def __init__(self, providers: Dict[str, Any], routes: Dict[str, List[str]],
+                 slow_seconds: Optional[Dict[str, float]] = None,
+                 max_error_rate: float = 0.5, cooldown: float = 60, fallback_retries: int = 1, min_calls: int = 3):
+        for operation, names in routes.items():
+            unknown = [name for name in names if name not in providers]
+            if unknown or not names:
+                raise ValueError(f"Маршрут LLM '{operation}': неизвестные провайдеры {unknown or names}")
+        if '*' not in routes:
+            raise ValueError("Нужен маршрут LLM по умолчанию '*'")
+        self.providers = providers
+        self.routes = routes
+        self.slow_seconds = dict(slow_seconds or {})
+        self.slow_seconds.setdefault('*', 15)
+        self.max_error_rate = max_error_rate
+        self.cooldown = cooldown
+        self.fallback_retries = fallback_retries
+        self.min_calls = min_calls
+        self._health: Dict[tuple, ProviderHealth] = {}
+
+    def health(self, name: str, operation: str) -> ProviderHealth:
+        key = (name, operation)
+        if key not in self._health:
+            self._health[key] = ProviderHealth()
+        return self._health[key]
+
+    def order(self, operation: str) -> List[str]:
+        """Провайдеры в порядке попыток: сначала здоровые по маршруту, затем деградировавшие."""
+        names = self.routes.get(operation) or self.routes['*']
+        now = time.monotonic()
+        healthy = [name for name in names if self.health(name, operation).degraded_until <= now]
+        degraded = sorted((name for name in names if name not in healthy),
+                          key=lambda name: self.health(name, operation).degraded_until)
+        return healthy + degraded
+
+    def _observe(self, name: str, operation: str, seconds: float, ok: bool):
+        health = self.health(name, operation)
+        health.observe(seconds, ok)
+        now = time.monotonic()
+        if health.calls >= self.min_calls and health.degraded_until <= now and \
+                (health.error_rate > self.max_error_rate or
+                 health.latency > self.slow_seconds.get(operation, self.slow_seconds['*'])):
+            health.degraded_until = now + self.cooldown
+            print(f"LLM: {name} для {operation} деградировал (задержка {health.latency:.1f} с, "
+                  f"ошибок {health.error_rate:.0%}), отодвинут на {self.cooldown:.0f} с")
+
+    async def _call(self, operation: str, priority: int, call):
+        order = self.order(operation)
+        for i, name in enumerate(order):
+            provider = self.providers[name]
+            is_last = i == len(order) - 1
+
+            async def attempt(provider=provider, name=name):
+                # call может отметить timing['first'] - время первой части потока
+                timing = {}
+                started = time.monotonic()
+                try:
+                    result = await call(provider, timing)
+                except Exception:
+                    self._observe(name, operation, timing.get('first', time.monotonic()) - started, False)
+                    raise
+                self._observe(name, operation, timing.get('first', time.monotonic()) - started, True)
+                return result
+
+            try:
+                return await scheduler.run(attempt, priority, None if is_last else self.fallback_retries)
+            except Exception as e:
+                if is_last or not getattr(e, 'fallback', True):
+                    raise
+                LLM_FALLBACKS.inc(operation=operation, provider=name)
+                print(f"LLM: {name} не ответил на {operation} ({str(e)}), пробую {order[i + 1]}")
+
+    async def complete(self, operation: str, data: Dict[str, Any], api_key: str, folder_id: str,
+                       priority: int = INTERACTIVE, timeout: float = 60) -> Dict[str, Any]:
+        return await self._call(operation, priority,
+                                lambda provider, timing: provider.complete(data, api_key, folder_id, timeout, operation))
+
+    async def stream(self, operation: str, data: Dict[str, Any], api_key: str, folder_id: str, on_text: OnText,
+                     priority: int = INTERACTIVE, timeout: float = 60) -> Dict[str, Any]:
+        started = False
+
+        async def call(provider, timing):
+            async def tracked(text: str):
+                nonlocal started
+                started = True
+                timing.setdefault('first', time.monotonic())
+                await on_text(text)
+
+            try:
+                return await provider.stream(data, api_key, folder_id, tracked, timeout, operation)
+            except Exception as e:
+                # Часть текста уже показана - ответ другой модели с ней не сойдётся
+                e.fallback = not started
+                raise
+
+        return await self._call(operation, priority, call)
+
+
+def parse_thresholds(spec: str) -> Dict[str, float]:
+    """'*=15;generate_test=40' -> {вид запроса: порог}; одно число - порог для всех."""
+    if '=' not in spec:
+        return {'*': float(spec)}
+    return {operation: float(value[0]) for operation, value in parse_routes(spec).items()}
+
+
+def parse_routes(spec: str) -> Dict[str, List[str]]:
+    """'generate_hint=yandex-lite;*=yandex-lite,yandex-full' -> {вид запроса: провайдеры}."""
+    routes = {}
+    for part in spec.split(';'):
+        if part.strip():
+            operation, names = part.split('=', 1)
+            routes[operation.strip()] = [name.strip() for name in names.split(',') if name.strip()]
+    return routes
+
+
+def build_router() -> LLMRouter:
+    """
+    Провайдеры и маршруты из переменных окружения: LLM_ROUTES,
+    LLM_STUB_URL (провайдер 'stub'), LLM_CASSETTE и LLM_CASSETTE_MODE
+    (record - записывать ответы, replay - отвечать только из записи).
+    """
+    providers: Dict[str, Any] = {
+        'yandex-lite': HttpProvider('yandex-lite', COMPLETION_URL, os.getenv('YANDEX_LITE_MODEL', 'yandexgpt-lite')),
+        'yandex-full': HttpProvider('yandex-full', COMPLETION_URL, os.getenv('YANDEX_FULL_MODEL', 'yandexgpt')),
+    }
+    if os.getenv('LLM_STUB_URL'):
+        providers['stub'] = HttpProvider('stub', os.getenv('LLM_STUB_URL'), 'stub')
+    routes = parse_routes(os.getenv('LLM_ROUTES', DEFAULT_ROUTES))
+    cassette = os.getenv('LLM_CASSETTE')
+    if cassette and os.getenv('LLM_CASSETTE_MODE', 'replay') == 'replay':
+        providers = {'replay': RecordReplayProvider(cassette)}
+        routes = {'*': ['replay']}
+    elif cassette:
+        providers = {name: RecordReplayProvider(cassette, provider) for name, provider in providers.items()}
+    return LLMRouter(
+        providers, routes,
+        slow_seconds=parse_thresholds(os.getenv('LLM_SLOW_SECONDS', DEFAULT_SLOW_SECONDS)),
+        max_error_rate=float(os.getenv('LLM_MAX_ERROR_RATE', '0.5')),
+        cooldown=float(os.getenv('LLM_DEGRADED_COOLDOWN', '60'))
+    )
+
+
+router = build_router()
@@ -0,0 +1,167 @@
+import asyncio
+import itertools
+import os
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+# Приоритеты: запросы, которых ждёт пользователь, обслуживаются раньше фоновых
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+class RetryableError(Exception):
+    """Временная ошибка (429, 5xx, таймаут): запрос стоит повторить."""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    try:
+        return max(0.0, float(value)) if value is not None else None
+    except ValueError:
+        return None
+
+
+class _Job:
+    def __init__(self, request_fn, priority: int, future: asyncio.Future, max_retries: int):
+        self.request_fn = request_fn
+        self.priority = priority
+        self.future = future
+        self.max_retries = max_retries
+        self.attempt = 0
+        self.enqueued = time.monotonic()
+
+
+class LLMScheduler:
+    """
+    Единая очередь запросов к Yandex GPT. Ограничивает частоту (rps) и
+    число одновременных запросов (max_inflight), повторяет временные
+    ошибки с экспоненциальной задержкой со случайным разбросом и
+    учитывает Retry-After. Интерактивные запросы идут впереди фоновых.
+    Работает в общем цикле событий (async_runtime).
+    """
+
+    def __init__(self, rps: float = 5.0, max_inflight: int = 4, max_retries: int = 4,
+                 base_delay: float = 0.5, max_delay: float = 30.0):
+        self.rps = rps
+        self.max_inflight = max_inflight
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._workers = []
+        self._seq = itertools.count()
+        self._next_slot = 0.0
+        self._paused_until = 0.0
+        self._rate_lock: Optional[asyncio.Lock] = None
+        # Статистика
+        self.inflight = 0
+        self.delayed = 0
+        self.completed = 0
+        self.failed = 0
+        self.retries = 0
+        self.wait_avg = 0.0
+        self.wait_max = 0.0
+
+    def _start(self):
+        self._queue = asyncio.PriorityQueue()
+        self._rate_lock = asyncio.Lock()
+        self._workers = [asyncio.ensure_future(self._worker()) for _ in range(self.max_inflight)]
+
+    async def run(self, request_fn: Callable[[], Awaitable[Any]], priority: int = INTERACTIVE,
+                  max_retries: Optional[int] = None) -> Any:
+        """
+        Ставит запрос в очередь и ждёт результат. request_fn - корутинная
+        функция без аргументов, которая выполняет один HTTP-запрос и
+        бросает RetryableError при временной ошибке. max_retries заменяет
+        общее число повторов, например, когда есть запасная модель.
+        """
+        if self._queue is None:
+            self._start()
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(_Job(request_fn, priority, future, self.max_retries if max_retries is None else max_retries))
+        return await future
+
+    def _enqueue(self, job: _Job):
+        self._queue.put_nowait((job.priority, next(self._seq), job))
+
+    def _requeue(self, job: _Job):
+        self.delayed -= 1
+        self._enqueue(job)
+
+    async def _wait_for_slot(self):
+        # Слоты выдаются по очереди с интервалом 1/rps; после 429 с
+        # Retry-After вся очередь ждёт, пока квота не восстановится
+        async with self._rate_lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot, self._paused_until)
+            self._next_slot = slot + 1.0 / self.rps
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def _backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            delay += retry_after
+        return delay
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            _, _, job = await self._queue.get()
+            if job.future.done():
+                continue
+            await self._wait_for_slot()
+            if job.attempt == 0:
+                wait = time.monotonic() - job.enqueued
+                self.wait_max = max(self.wait_max, wait)
+                self.wait_avg = wait if self.completed + self.failed == 0 else 0.9 * self.wait_avg + 0.1 * wait
+            self.inflight += 1
+            try:
+                result = await job.request_fn()
+            except RetryableError as e:
+                if job.attempt < job.max_retries:
+                    delay = self._backoff(job.attempt, e.retry_after)
+                    job.attempt += 1
+                    self.retries += 1
+                    self.delayed += 1
+                    if e.retry_after is not None:
+                        self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                    print(f"LLM: {str(e)}, повтор {job.attempt}/{job.max_retries} через {delay:.1f} с")
+                    loop.call_later(delay, self._requeue, job)
+                else:
+                    self.failed += 1
+                    if not job.future.done():
+                        job.future.set_exception(e)
+            except Exception as e:
+                self.failed += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                self.completed += 1
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                self.inflight -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'queue_depth': self._queue.qsize() if self._queue is not None else 0,
+            'delayed': self.delayed,
+            'inflight': self.inflight,
+            'completed': self.completed,
+            'failed': self.failed,
+            'retries': self.retries,
+            'wait_avg': self.wait_avg,
+            'wait_max': self.wait_max
+        }
+
+
+scheduler = LLMScheduler(
+    rps=float(os.getenv('LLM_RPS', '5')),
+    max_inflight=int(os.getenv('LLM_MAX_INFLIGHT', '4')),
+    max_retries=int(os.getenv('LLM_MAX_RETRIES', '4'))
+)
@@ -0,0 +1,209 @@
+import asyncio
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+# Границы корзин гистограмм по умолчанию, секунды
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    escape = lambda v: v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in pairs) + '}'
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # метки -> [счётчики по корзинам, сумма, количество]
+        self._series: Dict[Labels, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _labels(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def snapshot(self) -> Dict[Labels, Tuple[List[int], float, int]]:
+        with self._lock:
+            return {key: (list(series[0]), series[1], series[2]) for key, series in self._series.items()}
+
+    def quantile(self, counts: List[int], total: int, q: float) -> float:
+        """Оценка квантиля по корзинам (верхняя граница корзины)."""
+        seen = 0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= q * total:
+                return bound
+        return float('inf')
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for key, (counts, total_sum, total) in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_format_labels(key, ("le", _format_value(bound)))} {cumulative}')
+            lines.append(f'{self.name}_bucket{_format_labels(key, ("le", "+Inf"))} {total}')
+            lines.append(f'{self.name}_sum{_format_labels(key)} {_format_value(total_sum)}')
+            lines.append(f'{self.name}_count{_format_labels(key)} {total}')
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1, **labels):
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        lines.extend(f'{self.name}{_format_labels(key)} {_format_value(value)}' for key, value in values)
+        return lines
+
+
+class Gauge:
+    """Значение снимается при каждом чтении вызовом fn()."""
+
+    def __init__(self, name: str, help: str, fn: Callable[[], float]):
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    def value(self) -> Optional[float]:
+        try:
+            return float(self.fn())
+        except Exception:
+            return None
+
+    def render(self) -> List[str]:
+        value = self.value()
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        if value is not None:
+            lines.append(f'{self.name} {_format_value(value)}')
+        return lines
+
+
+class Registry:
+    """
+    Метрики бота: гистограммы длительностей и размеров, счётчики и
+    датчики. Отдаются в текстовом формате Prometheus (render) и
+    периодически печатаются сводкой в лог (summary).
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric):
+                    raise ValueError(f"Метрика {metric.name} уже зарегистрирована с другим типом")
+                if isinstance(metric, Gauge):
+                    existing.fn = metric.fn
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, buckets))
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._add(Counter(name, help))
+
+    def gauge(self, name: str, help: str, fn: Callable[[], float]) -> Gauge:
+        return self._add(Gauge(name, help, fn))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            if isinstance(metric, Histogram):
+                for key, (counts, total_sum, total) in sorted(metric.snapshot().items()):
+                    if total:
+                        labels = ','.join(v for _, v in key)
+                        lines.append(f"  {metric.name}[{labels}]: n={total} avg={total_sum / total:.3g} "
+                                     f"p95<={metric.quantile(counts, total, 0.95):g}")
+        gauges = [f"{m.name}={_format_value(m.value())}" for m in metrics
+                  if isinstance(m, Gauge) and m.value() is not None]
+        if gauges:
+            lines.append("  " + " ".join(gauges))
+        return "Метрики:\n" + "\n".join(lines)
+
+
+registry = Registry()
+
+
+async def start_server(host: str, port: int) -> web.AppRunner:
+    """HTTP-эндпоинт /metrics в формате Prometheus; работает в общем цикле событий."""
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(body=registry.render().encode('utf-8'),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
+
+
+async def log_periodically(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        print(registry.summary())
@@ -0,0 +1,35 @@
+"""
+Перенос данных из bot_data.json (вместе с непрошедшим сворачивание
+журналом) в SQLite.
+
+    python migrate_to_sqlite.py --source bot_data.json --target bot_data.sqlite3
+
+После переноса запустите бота с STORAGE_BACKEND=sqlite.
+"""
+import argparse
+import os
+
+from storage import COLLECTIONS, JournalStorage, SqliteStorage
+
+
+def migrate(source: str, target: str):
+    journal = JournalStorage(source).open()
+    try:
+        data = {name: dict(journal.items(name)) for name in COLLECTIONS}
+    finally:
+        journal.close()
+    sqlite_store = SqliteStorage(target).open()
+    try:
+        sqlite_store.import_data(data)
+        for name in COLLECTIONS:
+            print(f"{name}: {sqlite_store.count(name)}")
+    finally:
+        sqlite_store.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Перенос bot_data.json в SQLite")
+    parser.add_argument('--source', default=os.getenv('DATA_FILE', 'bot_data.json'))
+    parser.add_argument('--target', default=os.getenv('SQLITE_FILE', 'bot_data.sqlite3'))
+    args = parser.parse_args()
+    migrate(args.source, args.target)
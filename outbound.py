@@ -0,0 +1,155 @@
+import queue
+import threading
+import time
+from typing import Any, Dict, Iterable
+
+import telebot
+from telebot.apihelper import ApiTelegramException
+
+from metrics import registry
+
+TELEGRAM_REQUEST_SECONDS = registry.histogram('telegram_request_seconds', 'Вызовы Telegram API, без ожидания лимитов')
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, keep: float = 0) -> float:
+        """Сколько ждать, пока в ведре будет токен сверх keep."""
+        # Запас больше ёмкости ведра не наберётся никогда
+        keep = max(0.0, min(keep, self.capacity - 1))
+        return max(0.0, (1 + keep - self.tokens) / self.rate)
+
+
+class OutboundLimiter:
+    """
+    Ограничение частоты исходящих запросов к Telegram: общее ведро токенов
+    на весь бот и по ведру на каждый чат. После ответа 429 все отправки
+    ждут retry_after. Фоновые рассылки оставляют запас токенов (keep),
+    чтобы ответы на сообщения пользователей не стояли за ними в очереди.
+    """
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3,
+                 max_chats: int = 10000):
+        # Ёмкость не меньше одного токена, иначе при rate < 1 отправка не дождётся токена
+        self.global_bucket = TokenBucket(global_rate, max(global_rate, 1))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_chats = max_chats
+        self._chats: Dict[Any, TokenBucket] = {}
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _chat_bucket(self, chat_id, now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.max_chats:
+                # Полные ведра ничем не отличаются от новых - их можно забыть
+                for key, idle in list(self._chats.items()):
+                    idle.refill(now)
+                    if idle.tokens >= idle.capacity:
+                        del self._chats[key]
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def acquire(self, chat_id, keep: float = 0):
+        """Ждёт, пока отправка в чат chat_id уложится в оба ограничения."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                chat = self._chat_bucket(str(chat_id), now)
+                chat.refill(now)
+                self.global_bucket.refill(now)
+                delay = max(chat.delay(), self.global_bucket.delay(keep), self._paused_until - now)
+                if delay <= 0:
+                    chat.tokens -= 1
+                    self.global_bucket.tokens -= 1
+                    return
+            time.sleep(delay)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class RateLimitedTeleBot(telebot.TeleBot):
+    """
+    TeleBot, у которого отправка и правка сообщений проходят через
+    OutboundLimiter и повторяются после 429. broadcast() рассылает
+    уведомление многим чатам из фонового потока, не задерживая обработчик.
+    """
+
+    def __init__(self, *args, limiter: OutboundLimiter = None, max_retries: int = 3,
+                 broadcast_reserve: float = 5, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.limiter = limiter or OutboundLimiter()
+        self.max_retries = max_retries
+        self.broadcast_reserve = broadcast_reserve
+        self._broadcasts: queue.Queue = queue.Queue()
+        self._broadcast_thread = None
+        self._broadcast_lock = threading.Lock()
+        self.sent = 0
+        self.throttled = 0
+
+    def _limited(self, chat_id, keep: float, fn, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.limiter.acquire(chat_id, keep)
+            started = time.perf_counter()
+            status = 'ok'
+            try:
+                result = fn(*args, **kwargs)
+                self.sent += 1
+                return result
+            except ApiTelegramException as e:
+                status = str(e.error_code)
+                if e.error_code != 429 or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                self.throttled += 1
+                retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                print(f"Telegram: слишком много запросов, повтор через {retry_after} с")
+                self.limiter.pause(retry_after)
+            except Exception:
+                status = 'error'
+                raise
+            finally:
+                TELEGRAM_REQUEST_SECONDS.observe(time.perf_counter() - started, method=fn.__name__, status=status)
+
+    def send_message(self, chat_id, text, *args, **kwargs):
+        return self._limited(chat_id, 0, super().send_message, chat_id, text, *args, **kwargs)
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, *args, **kwargs):
+        return self._limited(chat_id, 0, super().edit_message_text, text, chat_id, message_id, *args, **kwargs)
+
+    def send_document(self, chat_id, *args, **kwargs):
+        return self._limited(chat_id, 0, super().send_document, chat_id, *args, **kwargs)
+
+    def broadcast(self, chat_ids: Iterable, text: str, **kwargs):
+        """Ставит рассылку в очередь и сразу возвращается."""
+        for chat_id in chat_ids:
+            self._broadcasts.put((chat_id, text, kwargs))
+        with self._broadcast_lock:
+            if self._broadcast_thread is None:
+                self._broadcast_thread = threading.Thread(target=self._broadcast_loop, name='broadcast', daemon=True)
+                self._broadcast_thread.start()
+
+    def _broadcast_loop(self):
+        while True:
+            chat_id, text, kwargs = self._broadcasts.get()
+            try:
+                self._limited(chat_id, self.broadcast_reserve, super().send_message, chat_id, text, **kwargs)
+            except Exception as e:
+                # Например, ученик заблокировал бота - остальным рассылка продолжается
+                print(f"Не удалось отправить уведомление в чат {chat_id}: {str(e)}")
+
+    def outbound_stats(self) -> Dict[str, Any]:
+        return {'sent': self.sent, 'throttled': self.throttled, 'broadcast_queue': self._broadcasts.qsize()}
@@ -0,0 +1,157 @@
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from telebot import types
+from telebot.apihelper import ApiTelegramException
+
+CALLBACK_PREFIX = 'pg:'
+MESSAGE_LIMIT = 4096
+
+# load(user_id, arg) -> (заголовок, ключи записей, функция отрисовки одной записи)
+# или None, если отчёт недоступен этому пользователю
+Loader = Callable[[str, str], Optional[Tuple[str, List[Any], Callable[[Any], str]]]]
+
+
+class PagedReports:
+    """
+    Отчёты, которые показываются одним сообщением с кнопками «назад/вперёд».
+    Загрузчик отчёта возвращает только ключи записей (курсор по данным),
+    а текст собирается лишь для записей показываемой страницы. На страницу
+    попадает до page_size целых записей, пока текст помещается в сообщение;
+    запись длиннее сообщения делится по строкам на несколько страниц.
+    Страница задаётся позицией первой записи, кнопки передают
+    'pg:<отчёт>:<аргумент>:<запись>.<часть>'. При листании сообщение
+    редактируется.
+    """
+
+    def __init__(self, page_size: int = 5):
+        self.page_size = page_size
+        self._loaders: Dict[str, Loader] = {}
+
+    def report(self, kind: str):
+        """Декоратор, регистрирующий загрузчик отчёта kind."""
+        def decorator(load: Loader):
+            if kind in self._loaders:
+                raise ValueError(f"Отчёт '{kind}' уже зарегистрирован")
+            self._loaders[kind] = load
+            return load
+        return decorator
+
+    @staticmethod
+    def _parts(text: str, limit: int) -> List[str]:
+        """Запись целиком или, если она длиннее limit, её куски по границам строк."""
+        if len(text) <= limit:
+            return [text]
+        parts, current = [], ''
+        for line in text.split('\n'):
+            while len(line) > limit:
+                if current:
+                    parts.append(current)
+                    current = ''
+                parts.append(line[:limit])
+                line = line[limit:]
+            if current and len(current) + 1 + len(line) > limit:
+                parts.append(current)
+                current = line
+            else:
+                current = f"{current}\n{line}" if current else line
+        if current:
+            parts.append(current)
+        return parts
+
+    def _page(self, keys: List[Any], render_entry: Callable[[Any], str], entry: int, part: int,
+              limit: int) -> Tuple[List[str], Tuple[int, int]]:
+        """Куски текста страницы, начинающейся с (entry, part), и позиция следующей."""
+        texts: List[str] = []
+        used = entries = 0
+        while entry < len(keys) and entries < self.page_size:
+            parts = self._parts(render_entry(keys[entry]), limit)
+            part = min(part, len(parts) - 1)
+            if texts and used + len(parts[part]) + 2 > limit:
+                break
+            texts.append(parts[part])
+            used += len(parts[part]) + 2
+            entries += 1
+            if part < len(parts) - 1:
+                # Длинная запись занимает страницу целиком, продолжение - на следующей
+                return texts, (entry, part + 1)
+            entry, part = entry + 1, 0
+        return texts, (entry, part)
+
+    def _previous(self, keys: List[Any], render_entry: Callable[[Any], str], entry: int, part: int,
+                  limit: int) -> Tuple[int, int]:
+        """Начало страницы, которая заканчивается перед (entry, part)."""
+        if part > 0:
+            return entry, part - 1
+        used = entries = 0
+        start = entry
+        while start > 0 and entries < self.page_size:
+            parts = self._parts(render_entry(keys[start - 1]), limit)
+            if len(parts) > 1:
+                return (start - 1, len(parts) - 1) if not entries else (start, 0)
+            if entries and used + len(parts[0]) + 2 > limit:
+                break
+            used += len(parts[0]) + 2
+            entries += 1
+            start -= 1
+        return start, 0
+
+    def render(self, kind: str, user_id: str, arg: str, position: str = '0.0'):
+        loaded = self._loaders[kind](user_id, arg)
+        if loaded is None:
+            return None, None
+        title, keys, render_entry = loaded
+        entry, _, part = position.partition('.')
+        entry, part = int(entry), int(part or 0)
+        if not keys or entry < 0 or part < 0:
+            entry = part = 0
+        elif entry >= len(keys):
+            entry, part = len(keys) - 1, 0
+        # Место под заголовок и строку «Записи … из …»
+        limit = MESSAGE_LIMIT - len(title) - 64
+        texts, (next_entry, next_part) = self._page(keys, render_entry, entry, part, limit)
+        has_previous = entry > 0 or part > 0
+        has_next = next_entry < len(keys)
+        footer = ""
+        if has_previous or has_next:
+            last = next_entry if next_part == 0 else next_entry + 1
+            footer = f"Записи {entry + 1}–{last} из {len(keys)}"
+        text = "\n\n".join(part for part in [title, *texts, footer] if part)
+        markup = None
+        if has_previous or has_next:
+            markup = types.InlineKeyboardMarkup()
+            buttons = []
+            if has_previous:
+                previous = self._previous(keys, render_entry, entry, part, limit)
+                buttons.append(types.InlineKeyboardButton(
+                    "◀️ Назад", callback_data=f"{CALLBACK_PREFIX}{kind}:{arg}:{previous[0]}.{previous[1]}"))
+            if has_next:
+                buttons.append(types.InlineKeyboardButton(
+                    "Вперёд ▶️", callback_data=f"{CALLBACK_PREFIX}{kind}:{arg}:{next_entry}.{next_part}"))
+            markup.row(*buttons)
+        return text, markup
+
+    def send(self, bot, chat_id, user_id: str, kind: str, arg: str = '', **kwargs):
+        """Отправляет первую страницу отчёта."""
+        text, markup = self.render(kind, user_id, arg)
+        if text is not None:
+            if markup is not None:
+                kwargs['reply_markup'] = markup
+            bot.send_message(chat_id, text, **kwargs)
+
+    def handle_callback(self, bot, call):
+        try:
+            kind, arg, position = call.data[len(CALLBACK_PREFIX):].rsplit(':', 2)
+            text, markup = self.render(kind, str(call.from_user.id), arg, position)
+        except (KeyError, ValueError):
+            text = None
+        if text is None:
+            bot.answer_callback_query(call.id, "Отчёт недоступен")
+            return
+        try:
+            bot.edit_message_text(text, chat_id=call.message.chat.id,
+                                  message_id=call.message.message_id, reply_markup=markup)
+        except ApiTelegramException as e:
+            # Повторное нажатие на ту же страницу: текст не изменился
+            if 'message is not modified' not in str(e):
+                raise
+        bot.answer_callback_query(call.id)
@@ -0,0 +1,135 @@
+import hashlib
+import random
+import re
+import threading
+import time
+from typing import Any, Dict, List, Set
+
+from nltk.stem.snowball import SnowballStemmer
+
+from metrics import registry
+from question_parser import is_near_duplicate
+from storage import Storage
+
+_stemmer = SnowballStemmer('russian')
+
+BANK_TAKEN = registry.counter('question_bank_taken_total', 'Вопросы, взятые из банка в новые тесты')
+BANK_ADDED = registry.counter('question_bank_added_total', 'Новые вопросы, сохранённые в банк')
+
+# Слова, которые не отличают одну тему или вопрос от другой
+STOPWORDS = {
+    'и', 'в', 'во', 'на', 'по', 'о', 'об', 'для', 'с', 'со', 'к', 'ко', 'из', 'у', 'от', 'до', 'за',
+    'под', 'над', 'при', 'про', 'что', 'как', 'какой', 'какая', 'какое', 'какие', 'это', 'или', 'а',
+    'но', 'не', 'ли', 'же', 'тема', 'класс', 'класса', 'урок'
+}
+
+
+def stems(text: str) -> List[str]:
+    words = re.findall(r'\w+', text.lower().replace('ё', 'е'))
+    return [_stemmer.stem(w) for w in words if len(w) > 1 and w not in STOPWORDS]
+
+
+def topic_key(topic: str) -> str:
+    """Нормализованная тема: отсортированные основы значимых слов."""
+    return ' '.join(sorted(set(stems(topic))))
+
+
+def fingerprint(question_text: str) -> str:
+    """Отпечаток вопроса, не зависящий от порядка слов, формы и пунктуации."""
+    return hashlib.sha1(' '.join(sorted(set(stems(question_text)))).encode('utf-8')).hexdigest()[:16]
+
+
+class QuestionBank:
+    """
+    Банк проверенных вопросов из всех сгенерированных тестов. Вопросы
+    хранятся в коллекции 'questions' с ключом-отпечатком (повторы не
+    сохраняются) и индексом по (сложность, нормализованная тема). Темы
+    сопоставляются по доле общих основ слов, поэтому «Дроби» и «дробь,
+    5 класс» находят одни и те же вопросы.
+    """
+
+    def __init__(self, store: Storage, topic_similarity: float = 0.6):
+        self.store = store
+        self.topic_similarity = topic_similarity
+        # основа слова -> нормализованные темы, в которых она встречается
+        self._topics_by_stem: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+        for question in store.values('questions'):
+            self._index_topic(question['topic_key'])
+
+    def _index_topic(self, key: str):
+        for stem in key.split():
+            self._topics_by_stem.setdefault(stem, set()).add(key)
+
+    def matching_topics(self, topic: str) -> List[str]:
+        """Темы банка, похожие на topic; сначала самые похожие."""
+        tokens = set(topic_key(topic).split())
+        if not tokens:
+            return []
+        with self._lock:
+            candidates = set().union(*(self._topics_by_stem.get(stem, set()) for stem in tokens))
+        scored = []
+        for key in candidates:
+            other = set(key.split())
+            similarity = len(tokens & other) / len(tokens | other)
+            if similarity >= self.topic_similarity:
+                scored.append((similarity, key))
+        return [key for _, key in sorted(scored, reverse=True)]
+
+    def take(self, topic: str, difficulty: str, count: int) -> List[Dict[str, Any]]:
+        """До count разных вопросов по теме; реже использованные - в первую очередь."""
+        difficulty = difficulty.strip().lower()
+        taken: List[Dict[str, Any]] = []
+        # Транзакция - чтобы параллельные генерации не теряли счётчики uses
+        with self.store.transaction():
+            for key in self.matching_topics(topic):
+                candidates = self.store.find('questions', difficulty=difficulty, topic_key=key)
+                random.shuffle(candidates)
+                candidates.sort(key=lambda q: q['uses'])
+                for record in candidates:
+                    if len(taken) >= count:
+                        break
+                    question = {field: record[field] for field in ('question', 'options', 'correct', 'explanation')}
+                    if is_near_duplicate(question, taken):
+                        continue
+                    taken.append(question)
+                    record = dict(record, uses=record['uses'] + 1)
+                    self.store.put('questions', record['id'], record)
+                if len(taken) >= count:
+                    break
+        BANK_TAKEN.inc(len(taken))
+        return taken
+
+    def add(self, topic: str, difficulty: str, questions: List[Dict[str, Any]]) -> int:
+        """Сохраняет новые вопросы; повторы и почти повторы пропускаются."""
+        key = topic_key(topic)
+        if not key:
+            return 0
+        difficulty = difficulty.strip().lower()
+        added = 0
+        with self.store.transaction():
+            existing = self.store.find('questions', difficulty=difficulty, topic_key=key)
+            for question in questions:
+                question_id = fingerprint(question['question'])
+                if self.store.get('questions', question_id) is not None or is_near_duplicate(question, existing):
+                    continue
+                record = {
+                    'id': question_id,
+                    'topic_key': key,
+                    'topic': topic,
+                    'difficulty': difficulty,
+                    'question': question['question'],
+                    'options': question['options'],
+                    'correct': question['correct'],
+                    'explanation': question.get('explanation', ''),
+                    'uses': 0,
+                    'added': time.time()
+                }
+                self.store.put('questions', question_id, record)
+                existing.append(record)
+                added += 1
+        BANK_ADDED.inc(added)
+        if added:
+            with self._lock:
+                self._index_topic(key)
+        return added
@@ -0,0 +1,141 @@
+import json
+import re
+from typing import Dict, Any, Optional, List, Set
+
+
+def validate_question(q: Any) -> Optional[Dict[str, Any]]:
+    """Проверяет вопрос из ответа модели и приводит его к формату теста."""
+    if not isinstance(q, dict):
+        return None
+    q = {k.lower(): v for k, v in q.items()}
+    if not all(k in q for k in ['question', 'options', 'correct']):
+        return None
+    if not isinstance(q['question'], str) or \
+       not isinstance(q['options'], list) or \
+       not isinstance(q['correct'], int):
+        return None
+    if len(q['question']) < 5 or \
+       len(q['options']) != 4 or \
+       q['correct'] < 0 or \
+       q['correct'] > 3:
+        return None
+    if len(set(q['options'])) != 4:
+        return None
+    correct_index = q['correct']
+    if q['options'][correct_index] in [opt for i, opt in enumerate(q['options']) if i != correct_index]:
+        return None
+    return {
+        'question': q['question'],
+        'options': q['options'],
+        'correct': q['correct'],
+        'explanation': q.get('explanation', '')
+    }
+
+
+def loads_lenient(raw: str) -> Any:
+    """json.loads, прощающий типичные ошибки модели: переводы строк внутри строк и висячие запятые."""
+    try:
+        return json.loads(raw, strict=False)
+    except json.JSONDecodeError:
+        return json.loads(re.sub(r',\s*([}\]])', r'\1', raw), strict=False)
+
+
+def parse_questions(text: str) -> List[Dict[str, Any]]:
+    """
+    Все корректные вопросы из ответа модели. Ответ, обрезанный по
+    maxTokens или с ошибкой в одном из вопросов, не выбрасывается
+    целиком: сохраняется каждый вопрос, объект которого закрыт.
+    """
+    return QuestionStreamParser().feed(text)
+
+
+def question_tokens(text: str) -> Set[str]:
+    return set(re.findall(r'\w+', text.lower().replace('ё', 'е')))
+
+
+def is_near_duplicate(question: Dict[str, Any], others: List[Dict[str, Any]], threshold: float = 0.75) -> bool:
+    """Похож ли вопрос на один из others (доля общих слов, мера Жаккара)."""
+    tokens = question_tokens(question['question'])
+    if not tokens:
+        return False
+    for other in others:
+        other_tokens = question_tokens(other['question'])
+        if other_tokens and len(tokens & other_tokens) / len(tokens | other_tokens) >= threshold:
+            return True
+    return False
+
+
+class QuestionStreamParser:
+    """
+    Разбирает ответ модели по мере поступления. feed() получает весь
+    текст, накопленный к этому моменту, просматривает только новую часть
+    и возвращает вопросы, объекты которых уже полностью закрыты внутри
+    массива "questions". Незаконченный хвост ждёт следующего вызова.
+    """
+
+    def __init__(self):
+        self._pos = 0              # до какого символа текст уже просмотрен
+        self._array_found = False
+        self._depth = 0            # вложенность скобок внутри массива вопросов
+        self._in_string = False
+        self._escape = False
+        self._object_start = -1
+        self._done = False
+
+    def _find_array(self, text: str) -> bool:
+        # Скобка до ключа может оказаться во вступлении или в другом поле,
+        # поэтому без ключа принимается только ответ, который начинается с массива
+        key = text.find('"questions"')
+        if key != -1:
+            start = text.find('[', key + len('"questions"'))
+        else:
+            body = text.lstrip()
+            if body.startswith('```'):
+                body = body.partition('\n')[2].lstrip()
+            start = len(text) - len(body) if body.startswith('[') else -1
+        if start == -1:
+            return False
+        self._array_found = True
+        self._pos = start + 1
+        return True
+
+    def feed(self, text: str) -> List[Dict[str, Any]]:
+        if self._done:
+            return []
+        if not self._array_found and not self._find_array(text):
+            return []
+        questions = []
+        i = self._pos
+        while i < len(text):
+            ch = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in '{[':
+                if self._depth == 0 and ch == '{':
+                    self._object_start = i
+                self._depth += 1
+            elif ch in '}]':
+                if self._depth == 0:
+                    # Закрылся сам массив вопросов
+                    self._done = True
+                    i += 1
+                    break
+                self._depth -= 1
+                if self._depth == 0 and ch == '}' and self._object_start != -1:
+                    try:
+                        question = validate_question(loads_lenient(text[self._object_start:i + 1]))
+                    except json.JSONDecodeError:
+                        question = None
+                    if question:
+                        questions.append(question)
+                    self._object_start = -1
+            i += 1
+        self._pos = i
+        return questions
@@ -0,0 +1,82 @@
+import threading
+from collections import Counter
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from metrics import registry
+
+HANDLER_SECONDS = registry.histogram('handler_seconds', 'Время работы обработчика сообщения')
+
+
+class DuplicateRouteError(ValueError):
+    pass
+
+
+def state_key(state: Dict[str, Any]) -> Optional[str]:
+    """
+    Ключ маршрута для состояния пользователя: первое непустое поле.
+    Для строковых значений ключ включает значение ('registering:student').
+    """
+    for key, value in state.items():
+        if value:
+            return f"{key}:{value}" if isinstance(value, str) else key
+    return None
+
+
+class MessageRouter:
+    """
+    Диспетчер текстовых сообщений. Обработчик выбирается одним поиском в
+    словаре: сначала по точному тексту кнопки меню, затем по текущему
+    состоянию пользователя. Кнопки меню имеют приоритет, чтобы из любого
+    незавершённого сценария можно было выйти (например, «❌ Отмена»).
+    """
+
+    def __init__(self, get_state: Callable[[str], Dict[str, Any]]):
+        self.get_state = get_state
+        self._text_routes: Dict[str, Callable] = {}
+        self._state_routes: Dict[str, Callable] = {}
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def _register(self, routes: Dict[str, Callable], key: str, handler: Callable):
+        if key in routes:
+            raise DuplicateRouteError(f"Маршрут '{key}' уже занят обработчиком {routes[key].__name__}")
+        routes[key] = handler
+
+    def text(self, text: str):
+        """Декоратор: обработчик нажатия кнопки с точным текстом text."""
+        def decorator(handler):
+            self._register(self._text_routes, text, handler)
+            return handler
+        return decorator
+
+    def state(self, key: str, value: Optional[str] = None):
+        """Декоратор: обработчик сообщений в состоянии key (или key == value)."""
+        route = f"{key}:{value}" if value is not None else key
+
+        def decorator(handler):
+            self._register(self._state_routes, route, handler)
+            return handler
+        return decorator
+
+    def resolve(self, message) -> Tuple[Optional[str], Optional[Callable]]:
+        handler = self._text_routes.get(message.text)
+        if handler is not None:
+            return f"text:{message.text}", handler
+        key = state_key(self.get_state(str(message.from_user.id)))
+        if key is not None and key in self._state_routes:
+            return f"state:{key}", self._state_routes[key]
+        return None, None
+
+    def dispatch(self, message) -> bool:
+        route, handler = self.resolve(message)
+        if handler is None:
+            return False
+        with self._lock:
+            self._counts[route] += 1
+        with HANDLER_SECONDS.time(route=route):
+            handler(message)
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counts)
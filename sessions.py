@@ -0,0 +1,115 @@
+import copy
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from storage import Storage
+
+
+class SessionStore:
+    """
+    Состояния диалогов пользователей (user_id -> состояние), используется
+    как словарь. Сессии, к которым не обращались дольше ttl секунд,
+    удаляются; при превышении max_sessions вытесняются самые давние.
+    Если передано хранилище, commit() после обработки обновления
+    сохраняет состояние в коллекцию 'sessions', и незаконченный тест
+    продолжается после перезапуска бота.
+    """
+
+    def __init__(self, store: Optional[Storage] = None, ttl: float = 6 * 3600, max_sessions: int = 10000):
+        self.store = store
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        # Порядок - по времени последнего обращения, самые давние в начале
+        self._sessions: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+        self._touched: Dict[str, float] = {}
+        self._committed: Dict[str, str] = {}
+        self._lock = threading.RLock()
+        if store is not None:
+            self._load()
+
+    def _load(self):
+        now = time.time()
+        for user_id, record in self.store.items('sessions'):
+            if now - record['updated'] > self.ttl:
+                self.store.delete('sessions', user_id)
+                continue
+            self._sessions[user_id] = copy.deepcopy(record['state'])
+            self._touched[user_id] = record['updated']
+            self._committed[user_id] = json.dumps(record['state'], ensure_ascii=False, sort_keys=True)
+        self._sessions = OrderedDict(sorted(self._sessions.items(), key=lambda item: self._touched[item[0]]))
+        self._evict(now)
+
+    def _drop(self, user_id: str):
+        self._sessions.pop(user_id, None)
+        self._touched.pop(user_id, None)
+        if self._committed.pop(user_id, None) is not None:
+            self.store.delete('sessions', user_id)
+
+    def _evict(self, now: float):
+        while self._sessions:
+            user_id = next(iter(self._sessions))
+            if now - self._touched[user_id] <= self.ttl and len(self._sessions) <= self.max_sessions:
+                break
+            self._drop(user_id)
+
+    def _touch(self, user_id: str, now: float):
+        self._touched[user_id] = now
+        self._sessions.move_to_end(user_id)
+
+    def get(self, user_id: str, default=None):
+        with self._lock:
+            state = self._sessions.get(user_id)
+            if state is None:
+                return default
+            now = time.time()
+            if now - self._touched[user_id] > self.ttl:
+                self._drop(user_id)
+                return default
+            self._touch(user_id, now)
+            return state
+
+    def __getitem__(self, user_id: str) -> Dict[str, Any]:
+        state = self.get(user_id)
+        if state is None:
+            raise KeyError(user_id)
+        return state
+
+    def __setitem__(self, user_id: str, state: Dict[str, Any]):
+        with self._lock:
+            now = time.time()
+            self._sessions[user_id] = state
+            self._touch(user_id, now)
+            self._evict(now)
+
+    def __delitem__(self, user_id: str):
+        with self._lock:
+            if user_id not in self._sessions:
+                raise KeyError(user_id)
+            self._sessions.pop(user_id)
+            self._touched.pop(user_id)
+
+    def __contains__(self, user_id: str) -> bool:
+        return self.get(user_id) is not None
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def commit(self, user_id: str):
+        """Сохраняет состояние пользователя, если оно изменилось."""
+        with self._lock:
+            state = self._sessions.get(user_id)
+            if not state:
+                # Закончившийся диалог не хранится вовсе
+                self._drop(user_id)
+                return
+            if self.store is None:
+                return
+            serialized = json.dumps(state, ensure_ascii=False, sort_keys=True)
+            if self._committed.get(user_id) == serialized:
+                return
+            self._committed[user_id] = serialized
+            # В хранилище уходит копия: обработчики меняют состояние на месте
+            self.store.put('sessions', user_id, {'state': json.loads(serialized), 'updated': self._touched[user_id]})
@@ -1,12 +1,33 @@
-import telebot
 from telebot import types
-import json
 import os
-from typing import Dict, Any, Optional
 import asyncio
-import aiohttp
+import functools
+import time
 from dotenv import load_dotenv
+import random
+import secrets
+import string
+import atexit
 import threading
+from concurrent.futures import ThreadPoolExecutor
+from storage import open_storage
+from async_runtime import runtime
+from yagpt import generate_test_sharded
+from generation_cache import GeneratedTestCache
+from hints import HintCache
+from question_bank import QuestionBank
+from router import MessageRouter
+from webhook import WebhookServer
+from dispatch_pool import PooledTeleBot
+from outbound import OutboundLimiter
+from sessions import SessionStore
+import aggregates
+import export
+from item_analysis import ItemAnalytics
+from pagination import PagedReports, CALLBACK_PREFIX, MESSAGE_LIMIT
+from llm_scheduler import scheduler
+import metrics
+from metrics import registry
 
 
 # Загрузка токена из .env
@@ -14,56 +35,175 @@ load_dotenv()
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_CODE = os.getenv('ADMIN_CODE', 'admin123')  # Код по умолчанию, если не указан в .env
 
-# Инициализация бота
-bot = telebot.TeleBot(BOT_TOKEN)
+# Инициализация бота: обновления обрабатываются пулом потоков,
+# сообщения одного пользователя - строго по порядку; исходящие
+# сообщения укладываются в лимиты Telegram (общий и на чат)
+bot = PooledTeleBot(
+    BOT_TOKEN,
+    workers=int(os.getenv('DISPATCH_WORKERS', '8')),
+    queue_size=int(os.getenv('DISPATCH_QUEUE_SIZE', '100')),
+    limiter=OutboundLimiter(
+        global_rate=float(os.getenv('TG_GLOBAL_RPS', '30')),
+        chat_rate=float(os.getenv('TG_CHAT_RPS', '1')),
+        chat_burst=float(os.getenv('TG_CHAT_BURST', '3'))
+    )
+)
 
 # Структура для хранения данных
-DATA_FILE = 'bot_data.json'
+DATA_FILE = os.getenv('DATA_FILE', 'bot_data.json')
+SQLITE_FILE = os.getenv('SQLITE_FILE', 'bot_data.sqlite3')
+# json - данные в памяти, изменения пишутся в журнал и сворачиваются в DATA_FILE;
+# sqlite - SQLITE_FILE с индексами (перенос данных: migrate_to_sqlite.py)
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json')
 
-def load_data() -> Dict[str, Any]:
-    if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            try:
-                data = json.load(f)
-                # Проверка наличия обязательных полей
-                if 'results' not in data:
-                    data['results'] = {}
-                return data
-            except json.JSONDecodeError:
-                print("Ошибка: Невозможно декодировать JSON. Создаю новый файл данных.")
-                return {
-                    'users': {},
-                    'classes': {},
-                    'tests': {},
-                    'results': {}
-                }
-    return {
-        'users': {},
-        'classes': {},
-        'tests': {},
-        'results': {}
-    }
-
-def save_data(data: Dict[str, Any]):
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
-# Хранение состояний пользователей
-user_states = {}
-
-def run_async(coro):
-    """Запускает асинхронную корутину в отдельном потоке."""
-    def wrapper():
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(coro)
-    threading.Thread(target=wrapper).start()
+store = open_storage(STORAGE_BACKEND, DATA_FILE, SQLITE_FILE)
+atexit.register(store.close)
+# Сводки для отчётов; для данных, сохранённых до их появления, - пересчёт
+aggregates.ensure_aggregates(store)
+
+# Кэш сгенерированных тестов: одинаковые запросы учителей не тратят токены
+test_cache = GeneratedTestCache(
+    os.getenv('TEST_CACHE_FILE', 'test_cache.json'),
+    max_entries=int(os.getenv('TEST_CACHE_SIZE', '200')),
+    ttl=float(os.getenv('TEST_CACHE_TTL', str(7 * 24 * 3600)))
+)
+
+# Банк вопросов: тест сначала собирается из уже проверенных вопросов по теме,
+# LLM генерирует только недостающие
+question_bank = QuestionBank(store, topic_similarity=float(os.getenv('BANK_TOPIC_SIMILARITY', '0.6')))
+
+# Подсказки к неверным вариантам ответов, готовятся заранее для каждого теста
+hint_cache = HintCache(store, os.getenv('YANDEX_API_KEY'), os.getenv('YANDEX_FOLDER_ID'))
+
+# Хранение состояний пользователей: заброшенные диалоги удаляются по TTL,
+# состояния сохраняются после каждого обновления и переживают перезапуск
+user_states = SessionStore(
+    store if os.getenv('SESSION_PERSIST', '1') == '1' else None,
+    ttl=float(os.getenv('SESSION_TTL', str(6 * 3600))),
+    max_sessions=int(os.getenv('SESSION_MAX', '10000'))
+)
+bot.after_update(user_states.commit)
+
+# Все текстовые сообщения проходят через один обработчик, который выбирает
+# сценарий по тексту кнопки или по состоянию пользователя за O(1)
+router = MessageRouter(lambda user_id: user_states.get(user_id, {}))
+
+# Длинные отчёты показываются постранично в одном сообщении
+reports = PagedReports(page_size=int(os.getenv('REPORT_PAGE_SIZE', '5')))
+
+# Матрицы ответов для анализа заданий: строятся по запросу, дополняются новыми результатами
+item_analytics = ItemAnalytics(store, max_tests=int(os.getenv('ITEM_ANALYSIS_CACHE_SIZE', '200')))
+
+# Выгрузки пишутся в отдельных потоках, чтобы не занимать пул обработчиков
+export_pool = ThreadPoolExecutor(max_workers=int(os.getenv('EXPORT_WORKERS', '2')), thread_name_prefix='export')
+atexit.register(export_pool.shutdown)
+
+# Общий цикл событий для запросов к LLM: один поток и пул соединений
+# на всё время работы бота вместо потока и сессии на каждый запрос
+runtime.start()
+atexit.register(runtime.stop)
+# Принятые обновления дорабатываются до остановки цикла событий и хранилища
+atexit.register(bot.pool.stop)
+
+# Метрики: длительности замеряют сами модули, здесь - датчики состояния бота.
+# METRICS_PORT включает эндпоинт Prometheus, METRICS_LOG_INTERVAL - сводку в логе
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = os.getenv('METRICS_PORT')
+METRICS_LOG_INTERVAL = float(os.getenv('METRICS_LOG_INTERVAL', '300'))
+registry.gauge('user_states', 'Активные диалоги пользователей', lambda: len(user_states))
+registry.gauge('threads', 'Потоки процесса', threading.active_count)
+registry.gauge('dispatch_queue', 'Обновления в очередях пула обработчиков', lambda: bot.pool.stats()['queued'])
+registry.gauge('broadcast_queue', 'Уведомления в очереди рассылки', lambda: bot.outbound_stats()['broadcast_queue'])
+registry.gauge('llm_queue', 'Запросы к LLM в очереди планировщика', lambda: scheduler.stats()['queue_depth'])
+registry.gauge('llm_inflight', 'Выполняющиеся запросы к LLM', lambda: scheduler.stats()['inflight'])
+registry.gauge('test_cache_entries', 'Записи в кэше сгенерированных тестов', lambda: test_cache.stats()['size'])
+registry.gauge('test_cache_hit_rate', 'Доля генераций, взятых из кэша тестов', lambda: test_cache.stats()['hit_rate'])
+registry.gauge('question_bank', 'Вопросы в банке', lambda: store.count('questions'))
+registry.gauge('store_size_bytes', 'Данные на диске (снимок и журнал или база SQLite)', store.disk_size)
+
+def start_metrics():
+    if METRICS_PORT:
+        runtime.submit(metrics.start_server(METRICS_HOST, int(METRICS_PORT))).result()
+    if METRICS_LOG_INTERVAL > 0:
+        runtime.submit(metrics.log_periodically(METRICS_LOG_INTERVAL))
+
+async def send_message_async(chat_id, text, **kwargs):
+    """Отправка сообщения из общего цикла событий: вызов Telegram API
+    уходит в пул потоков и не задерживает остальные запросы к LLM."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(bot.send_message, chat_id, text, **kwargs))
+
+async def run_blocking(fn, *args, **kwargs):
+    """Запись в хранилище или файл из общего цикла событий: транзакция
+    SQLite может ждать блокировку другого процесса, и цикл не должен стоять."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(fn, *args, **kwargs))
+
+async def edit_message_async(chat_id, message_id, text, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(
+        bot.edit_message_text, text, chat_id=chat_id, message_id=message_id, **kwargs))
+
+# Потоковая генерация тестов: вопросы показываются учителю по мере готовности
+STREAM_GENERATION = os.getenv('STREAM_GENERATION', '1') == '1'
+# Telegram ограничивает частоту правок одного сообщения
+PROGRESS_EDIT_INTERVAL = float(os.getenv('PROGRESS_EDIT_INTERVAL', '1.0'))
+# Сколько подсказок к итогу теста запрашивается одновременно
+RESULT_HINT_CONCURRENCY = int(os.getenv('RESULT_HINT_CONCURRENCY', '5'))
+
+class ProgressMessage:
+    """
+    Сообщение, которое редактируется по мере выполнения долгой операции.
+    update() не ждёт Telegram: правки идут в фоне не чаще раза в
+    PROGRESS_EDIT_INTERVAL, промежуточные тексты при этом пропускаются.
+    Уже отправленное сообщение передаётся через message_id и text.
+    """
+
+    def __init__(self, chat_id, message_id=None, text=None):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self._text = text
+        self._shown = text
+        self._last_edit = time.monotonic() if message_id is not None else 0.0
+        self._task = None
+
+    async def start(self, text):
+        message = await send_message_async(self.chat_id, text)
+        self.message_id = message.message_id
+        self._text = self._shown = text
+        self._last_edit = time.monotonic()
+
+    def update(self, text):
+        self._text = text
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._flush())
+
+    async def _flush(self):
+        while self._text != self._shown:
+            delay = self._last_edit + PROGRESS_EDIT_INTERVAL - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self._edit(self._text)
+
+    async def _edit(self, text):
+        self._last_edit = time.monotonic()
+        self._shown = text
+        try:
+            await edit_message_async(self.chat_id, self.message_id, text)
+        except Exception as e:
+            print(f"Не удалось обновить сообщение: {str(e)}")
+
+    async def finish(self, text):
+        if self._task is not None:
+            await self._task
+        if text != self._shown:
+            await self._edit(text)
 
 @bot.message_handler(commands=['start'])
 def start(message):
-    data = load_data()
     user_id = str(message.from_user.id)
-    if user_id not in data['users']:
+    user = store.get('users', user_id)
+    if user is None:
         markup = types.InlineKeyboardMarkup()
         teacher_button = types.InlineKeyboardButton("Я учитель", callback_data='register_teacher')
         student_button = types.InlineKeyboardButton("Я ученик", callback_data='register_student')
@@ -72,12 +212,11 @@ def start(message):
                      f"Добро пожаловать, {message.from_user.first_name}! Пожалуйста, выберите вашу роль:",
                      reply_markup=markup)
     else:
-        role = "учителя" if data['users'][user_id]['role'] == 'teacher' else "ученика"
+        role = "учителя" if user['role'] == 'teacher' else "ученика"
         show_main_menu(user_id, message)
 
 def show_main_menu(user_id, message):
-    data = load_data()
-    role = data['users'][user_id]['role']
+    role = store.get('users', user_id)['role']
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
     
     if role == 'teacher':
@@ -87,6 +226,8 @@ def show_main_menu(user_id, message):
         markup.add(types.KeyboardButton("Просмотреть тесты"))
         markup.add(types.KeyboardButton("Назначить тест"))
         markup.add(types.KeyboardButton("Просмотреть результаты"))
+        markup.add(types.KeyboardButton("Анализ теста"))
+        markup.add(types.KeyboardButton("Экспорт результатов"))
     elif role == 'student':
         # Кнопки только для ученика
         markup.add(types.KeyboardButton("Мои тесты"))
@@ -94,6 +235,10 @@ def show_main_menu(user_id, message):
     
     bot.reply_to(message, "Выберите действие:", reply_markup=markup)
 
+@bot.callback_query_handler(func=lambda call: call.data.startswith(CALLBACK_PREFIX))
+def handle_page_callback(call):
+    reports.handle_callback(bot, call)
+
 @bot.callback_query_handler(func=lambda call: True)
 def handle_callback(call):
     user_id = str(call.from_user.id)
@@ -112,44 +257,41 @@ def handle_callback(call):
             text="Пожалуйста, введите код доступа к классу, предоставленный учителем:"
         )
 
-@bot.message_handler(func=lambda message: user_states.get(str(message.from_user.id), {}).get('registering') == 'student')
+@router.state('registering', 'student')
 def handle_student_registration(message):
     user_id = str(message.from_user.id)
-    entered_code = message.text.strip()
-    data = load_data()
-    class_found = False
-    for class_id, class_info in data['classes'].items():
-        if class_info.get('access_code') == entered_code:
-            class_found = True
-            if user_id not in data['users']:
-                data['users'][user_id] = {
+    entered_code = message.text.strip().upper()
+    class_info = store.find_one('classes', access_code=entered_code)
+    if class_info is not None:
+        if store.get('users', user_id) is None:
+            # Ученики одного класса регистрируются параллельно - список
+            # перечитывается и дополняется внутри транзакции
+            with store.transaction():
+                store.put('users', user_id, {
                     'role': 'student',
                     'username': message.from_user.first_name,
-                    'class_id': class_id
-                }
-                class_info['students'].append(user_id)
-                save_data(data)
-                bot.reply_to(message, f"Вы успешно присоединились к классу '{class_info['name']}'!")
-            else:
-                bot.reply_to(message, "Вы уже зарегистрированы.")
-            break
-    if not class_found:
+                    'class_id': class_info['id']
+                })
+                class_info = store.get('classes', class_info['id'])
+                store.put('classes', class_info['id'], dict(class_info, students=class_info['students'] + [user_id]))
+            bot.reply_to(message, f"Вы успешно присоединились к классу '{class_info['name']}'!")
+        else:
+            bot.reply_to(message, "Вы уже зарегистрированы.")
+    else:
         bot.reply_to(message, "Неверный код доступа. Попробуйте снова или свяжитесь с учителем.")
     if user_id in user_states:
         del user_states[user_id]
 
-@bot.message_handler(func=lambda message: user_states.get(str(message.from_user.id), {}).get('registering') == 'teacher')
+@router.state('registering', 'teacher')
 def handle_teacher_registration(message):
     user_id = str(message.from_user.id)
     entered_code = message.text.strip()
     if entered_code == ADMIN_CODE:
-        data = load_data()
-        if user_id not in data['users']:
-            data['users'][user_id] = {
+        if store.get('users', user_id) is None:
+            store.put('users', user_id, {
                 'role': 'teacher',
                 'username': message.from_user.first_name
-            }
-            save_data(data)
+            })
             bot.reply_to(message, "Вы успешно зарегистрированы как учитель!")
         else:
             bot.reply_to(message, "Вы уже зарегистрированы.")
@@ -158,60 +300,62 @@ def handle_teacher_registration(message):
     if user_id in user_states:
         del user_states[user_id]
 
-@bot.message_handler(func=lambda message: message.text == "Создать класс")
+@router.text("Создать класс")
 def create_class(message):
-    data = load_data()
     user_id = str(message.from_user.id)
-    if user_id not in data['users'] or data['users'][user_id]['role'] != 'teacher':
+    if store.get('users', user_id, {}).get('role') != 'teacher':
         bot.reply_to(message, "Эта команда доступна только для учителей.")
         return
     user_states[user_id] = {'creating_class': True}
     bot.reply_to(message, "Введите название класса (например, '7A-2023'):")
 
-@bot.message_handler(func=lambda message: user_states.get(str(message.from_user.id), {}).get('creating_class'))
+@router.state('creating_class')
 def handle_create_class(message):
     user_id = str(message.from_user.id)
     class_name = message.text.strip()
     if len(class_name) < 3:
         bot.reply_to(message, "Название класса слишком короткое. Попробуйте снова:")
         return
-    data = load_data()
-    class_id = str(len(data['classes']) + 1)
-    import random
-    import string
-    access_code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-    data['classes'][class_id] = {
-        'id': class_id,
-        'name': class_name,
-        'teacher_id': user_id,
-        'students': [],
-        'access_code': access_code
-    }
-    save_data(data)
+    with store.transaction():
+        class_id = store.next_id('classes')
+        access_code = generate_access_code()
+        store.put('classes', class_id, {
+            'id': class_id,
+            'name': class_name,
+            'teacher_id': user_id,
+            'students': [],
+            'access_code': access_code
+        })
     del user_states[user_id]['creating_class']
     bot.reply_to(message, f"Класс '{class_name}' успешно создан!\nID класса: {class_id}\nКод доступа: {access_code}")
 
-@bot.message_handler(func=lambda message: message.text == "Создать тест")
+def generate_access_code() -> str:
+    """Случайный код доступа, которого ещё нет ни у одного класса."""
+    alphabet = string.ascii_uppercase + string.digits
+    while True:
+        access_code = ''.join(random.choices(alphabet, k=6))
+        if store.find_one('classes', access_code=access_code) is None:
+            return access_code
+
+@router.text("Создать тест")
 def handle_create_test(message):
-    data = load_data()
     user_id = str(message.from_user.id)
-    if data['users'].get(user_id, {}).get('role') != 'teacher':
+    if store.get('users', user_id, {}).get('role') != 'teacher':
         bot.reply_to(message, "Эта команда доступна только для учителей.")
         return
     user_states[user_id] = {'creating_test': {'step': 1}}
     bot.reply_to(message, "Введите тему теста:")
 
 
-@bot.message_handler(func=lambda message: message.text == "Просмотреть результаты")
+@router.text("Просмотреть результаты")
 def handle_view_results(message):
-    data = load_data()
     user_id = str(message.from_user.id)
     
-    if data['users'].get(user_id, {}).get('role') != 'teacher':
+    if store.get('users', user_id, {}).get('role') != 'teacher':
         bot.reply_to(message, "🚫 Эта команда доступна только учителям")
         return
 
-    teacher_classes = [c for c in data['classes'].values() if c['teacher_id'] == user_id]
+    teacher_classes = store.find('classes', teacher_id=user_id)
     if not teacher_classes:
         bot.reply_to(message, "У вас нет созданных классов.")
         return
@@ -225,15 +369,14 @@ def handle_view_results(message):
     user_states[user_id] = {'viewing_results': {'step': 1}}
     bot.reply_to(message, "Выберите класс для просмотра результатов:", reply_markup=markup)
 
-@bot.message_handler(func=lambda message: user_states.get(str(message.from_user.id), {}).get('viewing_results'))
+@router.state('viewing_results')
 def handle_view_results_message(message):
-    data = load_data()
     user_id = str(message.from_user.id)
     state = user_states.get(user_id, {})
     if 'viewing_results' in state:
-        handle_view_results_logic(message, state, user_id, data)
+        handle_view_results_logic(message, state, user_id)
 
-@bot.message_handler(func=lambda message: user_states.get(str(message.from_user.id), {}).get('creating_test'))
+@router.state('creating_test')
 def handle_creating_test(message):
     user_id = str(message.from_user.id)
     state = user_states[user_id]['creating_test']
@@ -258,16 +401,34 @@ def handle_creating_test(message):
             bot.reply_to(message, "Неверный уровень сложности. Выберите из: легкий, средний, сложный.")
             return
         state['difficulty'] = difficulty
-        run_async(finalize_test_creation(
-            user_id=user_id,
-            topic=state['topic'],
-            num_questions=state['num_questions'],
-            difficulty=state['difficulty'],
-            chat_id=message.chat.id
-        ))
-        del user_states[user_id]['creating_test']
-
-def handle_view_results_logic(message, state, user_id, data):
+        if test_cache.contains(state['topic'], state['num_questions'], difficulty):
+            state['step'] = 4
+            markup = types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
+            markup.add(types.KeyboardButton("Да"), types.KeyboardButton("Нет, сгенерировать заново"))
+            bot.reply_to(message, "Уже есть готовый тест с такими параметрами. Использовать его?",
+                         reply_markup=markup)
+            return
+        start_test_generation(message, user_id, state, use_cache=True)
+    elif step == 4:
+        answer = message.text.strip().lower()
+        if not answer.startswith(('да', 'нет')):
+            bot.reply_to(message, "Ответьте «Да» или «Нет».")
+            return
+        bot.reply_to(message, "Готовлю тест...", reply_markup=types.ReplyKeyboardRemove())
+        start_test_generation(message, user_id, state, use_cache=answer.startswith('да'))
+
+def start_test_generation(message, user_id, state, use_cache):
+    runtime.submit(finalize_test_creation(
+        user_id=user_id,
+        topic=state['topic'],
+        num_questions=state['num_questions'],
+        difficulty=state['difficulty'],
+        chat_id=message.chat.id,
+        use_cache=use_cache
+    ))
+    del user_states[user_id]['creating_test']
+
+def handle_view_results_logic(message, state, user_id):
     vr_state = state['viewing_results']
     step = vr_state['step']
     try:
@@ -275,19 +436,14 @@ def handle_view_results_logic(message, state, user_id, data):
             class_name = message.text.replace("Класс: ", "").strip()
             
             # Находим класс
-            selected_class = next(
-                (c for c in data['classes'].values() 
-                 if c['name'] == class_name and c['teacher_id'] == user_id),
-                None
-            )
+            selected_class = store.find_one('classes', teacher_id=user_id, name=class_name)
             
             if not selected_class:
                 bot.reply_to(message, "Класс не найден. Попробуйте снова.")
                 return
 
             # Получаем студентов класса (исправлено)
-            students = [(uid, u) for uid, u in data['users'].items() 
-                       if u.get('class_id') == selected_class['id']]
+            students = store.find_items('users', class_id=selected_class['id'])
             
             if not students:
                 bot.reply_to(message, f"В классе '{class_name}' пока нет учеников.", 
@@ -295,42 +451,8 @@ def handle_view_results_logic(message, state, user_id, data):
                 del user_states[user_id]['viewing_results']
                 return
 
-            # Формируем отчет
-            response = [f"📊 Результаты класса '{class_name}':\n"]
-            for student_id, student in students:  # Исправлено здесь
-                student_results = [
-                    r for r in data['results'].values() 
-                    if r['student_id'] == student_id  # Используем настоящий ID студента
-                ]
-
-                response.append(f"\n👤 {student['username']}:")
-                if not student_results:
-                    response.append(" Нет результатов")
-                    continue
-
-                for result in student_results:
-                    test = data['tests'].get(result['test_id'], {})
-                    response.append(
-                        f"\n📝 Тест: {test.get('topic', 'Неизвестно')} "
-                        f"(ID: {result['test_id']})"
-                    )
-                    response.append(
-                        f"✅ Правильно: {result['correct_answers']}/{result['total_questions']}"
-                    )
-                    
-                    if result.get('wrong_answers'):
-                        response.append("\n❌ Ошибки:")
-                        for idx, error in enumerate(result['wrong_answers'], 1):
-                            response.append(
-                                f"{idx}. Вопрос: {error['question']}\n"
-                                f"   Ваш ответ: {error['user_answer']}\n"
-                                f"   Правильный: {error['correct_answer']}"
-                            )
-
-            # Отправляем результаты частями
-            full_response = "\n".join(response)
-            for part in [full_response[i:i+4096] for i in range(0, len(full_response), 4096)]:
-                bot.send_message(message.chat.id, part)
+            # Отчёт листается кнопками, страницы собираются по запросу
+            reports.send(bot, message.chat.id, user_id, 'class_results', selected_class['id'])
 
             del user_states[user_id]['viewing_results']
 
@@ -339,7 +461,189 @@ def handle_view_results_logic(message, state, user_id, data):
         if user_id in user_states and 'viewing_results' in user_states[user_id]:
             del user_states[user_id]['viewing_results']
 
-@bot.message_handler(func=lambda message: message.text == "❌ Отмена")
+@reports.report('class_results')
+def load_class_results(user_id, class_id):
+    selected_class = store.get('classes', class_id)
+    if not selected_class or selected_class['teacher_id'] != user_id:
+        return None
+    # Отчёт строится по сводкам: одна запись на ученика
+    class_stats = store.get('class_stats', class_id)
+    title = f"📊 Результаты класса '{selected_class['name']}':"
+    if class_stats and class_stats['total']:
+        title += (f"\nПопыток: {class_stats['attempts']}, "
+                  f"средний результат: {percent(class_stats['correct'], class_stats['total'])}%")
+    keys = [('student', student_id, student['username'])
+            for student_id, student in store.find_items('users', class_id=class_id)]
+    if class_stats:
+        keys.extend(('errors', test_id, errors) for test_id, errors in class_stats['errors'].items()
+                    if errors['questions'])
+    return title, keys, render_class_results_entry
+
+def render_class_results_entry(key):
+    if key[0] == 'errors':
+        _, test_id, errors = key
+        top = sorted(errors['questions'].items(), key=lambda item: -item[1])[:3]
+        lines = [f"🔎 Чаще всего ошибаются: {errors['topic']} (ID: {test_id})"]
+        lines.extend(f"• {question} - {count}" for question, count in top)
+        return "\n".join(lines)
+    _, student_id, username = key
+    stats = store.get('student_stats', student_id)
+    if not stats or not stats['attempts']:
+        return f"👤 {username}:\n Нет результатов"
+    last = stats['last_attempt']
+    lines = [
+        f"👤 {username}:",
+        f"Попыток: {stats['attempts']}, правильных ответов: "
+        f"{stats['correct']}/{stats['total']} ({percent(stats['correct'], stats['total'])}%)",
+        f"📝 Последний тест: {last['topic']} (ID: {last['test_id']})",
+        f"✅ Правильно: {last['correct_answers']}/{last['total_questions']}"
+    ]
+    if last['wrong_answers']:
+        lines.append("❌ Ошибки:")
+        for idx, error in enumerate(last['wrong_answers'], 1):
+            lines.append(
+                f"{idx}. Вопрос: {error['question']}\n"
+                f"   Ваш ответ: {error['user_answer']}\n"
+                f"   Правильный: {error['correct_answer']}"
+            )
+    return "\n".join(lines)
+
+@router.text("Анализ теста")
+def handle_item_analysis(message):
+    user_id = str(message.from_user.id)
+    if store.get('users', user_id, {}).get('role') != 'teacher':
+        bot.reply_to(message, "Эта команда доступна только для учителей.")
+        return
+    tests = store.find('tests', teacher_id=user_id)
+    if not tests:
+        bot.reply_to(message, "У вас пока нет созданных тестов.")
+        return
+    markup = types.ReplyKeyboardMarkup(one_time_keyboard=True)
+    for test in tests:
+        markup.add(types.KeyboardButton(f"Тест ID: {test['id']} - {test['topic']}"))
+    user_states[user_id] = {'analyzing_test': True}
+    bot.reply_to(message, "Выберите тест для анализа заданий:", reply_markup=markup)
+
+@router.state('analyzing_test')
+def handle_item_analysis_message(message):
+    user_id = str(message.from_user.id)
+    test_id = message.text.split("ID: ")[-1].split(" - ")[0].strip()
+    test = store.get('tests', test_id)
+    if test is None or test['teacher_id'] != user_id:
+        bot.reply_to(message, "Тест не найден. Попробуйте снова.")
+        return
+    del user_states[user_id]['analyzing_test']
+    bot.reply_to(message, f"🔬 Анализ заданий теста «{test['topic']}»", reply_markup=types.ReplyKeyboardRemove())
+    reports.send(bot, message.chat.id, user_id, 'item_analysis', test_id)
+
+@reports.report('item_analysis')
+def load_item_analysis(user_id, test_id):
+    test = store.get('tests', test_id)
+    if test is None or test['teacher_id'] != user_id:
+        return None
+    stats = item_analytics.analyze(test_id)
+    if stats is None:
+        return f"📈 Тест «{test['topic']}» (ID: {test_id}): пока нет результатов.", [], None
+    lines = [
+        f"📈 Тест «{test['topic']}» (ID: {test_id})",
+        f"Учеников: {stats['students']}, попыток: {stats['attempts']}, "
+        f"средний результат: {round(stats['mean_percent'])}%"
+    ]
+    for class_id, values in stats['percentiles'].items():
+        name = store.get('classes', class_id, {}).get('name', 'без класса') if class_id else 'без класса'
+        p25, p50, p75, p90 = (round(v) for v in values)
+        lines.append(f"Класс {name}: P25 {p25}%, медиана {p50}%, P75 {p75}%, P90 {p90}%")
+    return "\n".join(lines), list(range(len(test['questions']))), \
+        functools.partial(render_item_entry, test, stats)
+
+def render_item_entry(test, stats, index):
+    question = test['questions'][index]
+    discrimination = stats['discrimination'][index]
+    if discrimination != discrimination:  # NaN: все ответили одинаково
+        quality = "не определена"
+    else:
+        quality = f"{discrimination:.2f}" + (" ⚠️ слабо различает учеников" if discrimination < 0.2 else "")
+    lines = [
+        f"{index + 1}. {question['question']}",
+        f"Решаемость: {round(100 * stats['difficulty'][index])}%, различающая способность: {quality}"
+    ]
+    for option_index, option in enumerate(question['options']):
+        mark = "✅" if option_index == question['correct'] else "▫️"
+        lines.append(f"{mark} {option} - {round(100 * stats['frequency'][index][option_index])}%")
+    return "\n".join(lines)
+
+@router.text("Экспорт результатов")
+def handle_export_results(message):
+    user_id = str(message.from_user.id)
+    if store.get('users', user_id, {}).get('role') != 'teacher':
+        bot.reply_to(message, "Эта команда доступна только для учителей.")
+        return
+    classes = store.find('classes', teacher_id=user_id)
+    if not classes:
+        bot.reply_to(message, "У вас нет созданных классов.")
+        return
+    markup = types.ReplyKeyboardMarkup(one_time_keyboard=True)
+    markup.add(types.KeyboardButton("Все классы"))
+    for class_info in classes:
+        markup.add(types.KeyboardButton(f"Класс: {class_info['name']}"))
+    user_states[user_id] = {'exporting': {'step': 1}}
+    bot.reply_to(message, "Выберите, чьи результаты выгрузить:", reply_markup=markup)
+
+@router.state('exporting')
+def handle_export_message(message):
+    user_id = str(message.from_user.id)
+    ex_state = user_states[user_id]['exporting']
+    if ex_state['step'] == 1:
+        if message.text == "Все классы":
+            ex_state['class_id'] = None
+        else:
+            class_info = store.find_one('classes', teacher_id=user_id, name=message.text.split("Класс: ")[-1].strip())
+            if class_info is None:
+                bot.reply_to(message, "Класс не найден. Попробуйте снова.")
+                return
+            ex_state['class_id'] = class_info['id']
+        ex_state['step'] = 2
+        markup = types.ReplyKeyboardMarkup(one_time_keyboard=True)
+        for fmt in export.FORMATS:
+            markup.add(types.KeyboardButton(fmt.upper()))
+        bot.reply_to(message, "Выберите формат файла:", reply_markup=markup)
+    else:
+        fmt = message.text.strip().lower()
+        if fmt not in export.FORMATS:
+            bot.reply_to(message, "Неизвестный формат. Попробуйте снова.")
+            return
+        class_id = ex_state['class_id']
+        del user_states[user_id]['exporting']
+        bot.reply_to(message, "⏳ Готовлю файл...", reply_markup=types.ReplyKeyboardRemove())
+        export_pool.submit(send_results_export, message.chat.id, user_id, class_id, fmt)
+
+def send_results_export(chat_id, user_id, class_id, fmt):
+    """Выгружает результаты в файл построчно и отправляет его учителю."""
+    path = None
+    try:
+        if class_id is None:
+            results = export.iter_teacher_results(store, user_id)
+            name = "все_классы"
+        else:
+            # Ученики класса могли проходить и тесты других учителей
+            results = (r for r in export.iter_class_results(store, class_id) if r.get('teacher_id') == user_id)
+            name = store.get('classes', class_id)['name']
+        question_columns = max((len(t['questions']) for t in store.find('tests', teacher_id=user_id)), default=0)
+        path, count = export.export_results(store, results, fmt, question_columns)
+        if count == 0:
+            bot.send_message(chat_id, "Пока нет результатов для выгрузки.")
+            return
+        with open(path, 'rb') as f:
+            bot.send_document(chat_id, f, visible_file_name=f"результаты_{name}.{fmt}",
+                              caption=f"📊 Результатов: {count}")
+    except Exception as e:
+        print(f"Ошибка выгрузки результатов: {str(e)}")
+        bot.send_message(chat_id, f"Ошибка при выгрузке результатов: {str(e)}")
+    finally:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+@router.text("❌ Отмена")
 def cancel_operation(message):
     user_id = str(message.from_user.id)
     if user_id in user_states:
@@ -347,15 +651,14 @@ def cancel_operation(message):
     bot.reply_to(message, "Операция отменена", reply_markup=types.ReplyKeyboardRemove())
 
 
-@bot.message_handler(func=lambda message: user_states.get(str(message.from_user.id), {}).get('assigning_test'))
+@router.state('assigning_test')
 def handle_assign_test_message(message):
-    data = load_data()
     user_id = str(message.from_user.id)
     state = user_states.get(user_id, {})
     if 'assigning_test' in state:
-        handle_assign_test(message, state, user_id, data)
+        handle_assign_test(message, state, user_id)
 
-def handle_assign_test(message, state, user_id, data):
+def handle_assign_test(message, state, user_id):
     ct_state = state['assigning_test']
     step = ct_state['step']
     try:
@@ -365,12 +668,12 @@ def handle_assign_test(message, state, user_id, data):
                 bot.reply_to(message, "Неверный формат теста. Попробуйте снова.")
                 return
             test_id = parts[1].split(" - ")[0].strip()
-            if test_id not in data['tests']:
+            if store.get('tests', test_id) is None:
                 bot.reply_to(message, "Тест не найден. Попробуйте снова.")
                 return
             ct_state['test_id'] = test_id
             ct_state['step'] = 2
-            classes = [c for c in data['classes'].values() if c['teacher_id'] == user_id]
+            classes = store.find('classes', teacher_id=user_id)
             if not classes:
                 bot.reply_to(message, "У вас нет созданных классов.")
                 return
@@ -384,36 +687,37 @@ def handle_assign_test(message, state, user_id, data):
                 bot.reply_to(message, "Неверный формат класса. Попробуйте снова.")
                 return
             class_name = parts[1].strip()
-            class_found = False
-            for class_id, class_info in data['classes'].items():
-                if class_info['name'] == class_name and class_info['teacher_id'] == user_id:
-                    class_found = True
-                    data['tests'][ct_state['test_id']]['class_id'] = class_id
-                    save_data(data)
-                    break
-            if not class_found:
+            class_info = store.find_one('classes', teacher_id=user_id, name=class_name)
+            if class_info is None:
                 bot.reply_to(message, "Класс не найден. Попробуйте снова.")
                 return
+            with store.transaction():
+                test = dict(store.get('tests', ct_state['test_id']), class_id=class_info['id'])
+                store.put('tests', test['id'], test)
             bot.reply_to(message, f"Тест ID: {ct_state['test_id']} успешно назначен классу {class_name}.",
                          reply_markup=types.ReplyKeyboardRemove())
+            # Уведомления ученикам уходят в фоне с учётом лимитов Telegram
+            bot.broadcast(class_info.get('students', []),
+                          f"📢 Вам назначен новый тест: {test['topic']} (ID: {test['id']}).\n"
+                          f"Откройте «Мои тесты», чтобы пройти его.")
             del user_states[user_id]['assigning_test']
     except Exception as e:
         bot.reply_to(message, f"Ошибка: {str(e)}")
         if 'assigning_test' in user_states[user_id]:
             del user_states[user_id]['assigning_test']
 
-@bot.message_handler(func=lambda message: message.text == "Мои тесты")
+@router.text("Мои тесты")
 def my_tests(message):
-    data = load_data()
     user_id = str(message.from_user.id)
-    if user_id not in data['users'] or data['users'][user_id]['role'] != 'student':
+    user = store.get('users', user_id)
+    if user is None or user['role'] != 'student':
         bot.reply_to(message, "Эта команда доступна только для учеников.")  
         return
-    class_id = data['users'][user_id].get('class_id')
+    class_id = user.get('class_id')
     if not class_id:
         bot.reply_to(message, "Вы не присоединены ни к одному классу.")
         return
-    tests = [t for t in data['tests'].values() if t['class_id'] == class_id]
+    tests = store.find('tests', class_id=class_id)
     if not tests:
         bot.reply_to(message, "У вас нет назначенных тестов.")
         return
@@ -423,52 +727,47 @@ def my_tests(message):
     user_states[user_id] = {'taking_test': {'step': 1}}
     bot.reply_to(message, "Выберите тест для прохождения:", reply_markup=markup)
 
-@bot.message_handler(func=lambda message: user_states.get(str(message.from_user.id), {}).get('taking_test'))
+@router.state('taking_test')
 def handle_taking_test_message(message):
-    data = load_data()
     user_id = str(message.from_user.id)
     state = user_states.get(user_id, {})
     if 'taking_test' in state:
-        handle_taking_test(message, state, user_id, data)
+        handle_taking_test(message, state, user_id)
 
 
-@bot.message_handler(func=lambda message: message.text == "Просмотреть тесты")
+@router.text("Просмотреть тесты")
 def handle_view_tests(message):
-    data = load_data()
     user_id = str(message.from_user.id)
-    if data['users'].get(user_id, {}).get('role') != 'teacher':
+    if store.get('users', user_id, {}).get('role') != 'teacher':
         bot.reply_to(message, "🚫 Эта команда доступна только учителям")
         return
 
-    teacher_tests = [t for t in data['tests'].values() if t['teacher_id'] == user_id]
+    teacher_tests = store.find('tests', teacher_id=user_id)
     if not teacher_tests:
         bot.reply_to(message, "📭 У вас пока нет созданных тестов.")
         return
 
-    response = ["📚 Список ваших тестов:\n"]
-    for test in teacher_tests:
-        class_info = data['classes'].get(test.get('class_id', ''), {})
-        response.append(
-            f"🔹 ID: {test['id']}\n"
+    reports.send(bot, message.chat.id, user_id, 'tests')
+
+@reports.report('tests')
+def load_tests(user_id, arg):
+    return "📚 Список ваших тестов:", store.find('tests', teacher_id=user_id), render_test_entry
+
+def render_test_entry(test):
+    class_info = store.get('classes', test.get('class_id') or '', {})
+    return (f"🔹 ID: {test['id']}\n"
             f"Тема: {test['topic']}\n"
             f"Сложность: {test['difficulty']}\n"
             f"Вопросов: {len(test['questions'])}\n"
-            f"Класс: {class_info.get('name', 'Не назначен')}\n"
-            "--------------------------"
-        )
-    
-    full_response = "\n".join(response)
-    for part in [full_response[i:i+4096] for i in range(0, len(full_response), 4096)]:
-        bot.send_message(message.chat.id, part)
+            f"Класс: {class_info.get('name', 'Не назначен')}")
 
-@bot.message_handler(func=lambda message: message.text == "Назначить тест")
+@router.text("Назначить тест")
 def assign_test(message):
-    data = load_data()
     user_id = str(message.from_user.id)
-    if user_id not in data['users'] or data['users'][user_id]['role'] != 'teacher':
+    if store.get('users', user_id, {}).get('role') != 'teacher':
         bot.reply_to(message, "Эта команда доступна только для учителей.")
         return
-    tests = [t for t in data['tests'].values() if t['teacher_id'] == user_id]
+    tests = store.find('tests', teacher_id=user_id)
     if not tests:
         bot.reply_to(message, "У вас пока нет созданных тестов.")
         return
@@ -478,91 +777,7 @@ def assign_test(message):
     user_states[user_id] = {'assigning_test': {'step': 1}}
     bot.reply_to(message, "Выберите тест для назначения:", reply_markup=markup)
 
-@bot.message_handler(func=lambda message: user_states.get(str(message.from_user.id), {}).get('assigning_test'))
-def handle_assign_test_message(message):
-    data = load_data()
-    user_id = str(message.from_user.id)
-    state = user_states.get(user_id, {})
-    if 'assigning_test' in state:
-        handle_assign_test(message, state, user_id, data)
-
-def handle_assign_test(message, state, user_id, data):
-    ct_state = state['assigning_test']
-    step = ct_state['step']
-    try:
-        if step == 1:
-            parts = message.text.split("ID: ")
-            if len(parts) != 2:
-                bot.reply_to(message, "Неверный формат теста. Попробуйте снова.")
-                return
-            test_id = parts[1].split(" - ")[0].strip()
-            if test_id not in data['tests']:
-                bot.reply_to(message, "Тест не найден. Попробуйте снова.")
-                return
-            ct_state['test_id'] = test_id
-            ct_state['step'] = 2
-            classes = [c for c in data['classes'].values() if c['teacher_id'] == user_id]
-            if not classes:
-                bot.reply_to(message, "У вас нет созданных классов.")
-                return
-            markup = types.ReplyKeyboardMarkup(one_time_keyboard=True)
-            for class_info in classes:
-                markup.add(types.KeyboardButton(f"Класс: {class_info['name']}"))
-            bot.reply_to(message, "Выберите класс для назначения теста:", reply_markup=markup)
-        elif step == 2:
-            parts = message.text.split("Класс: ")
-            if len(parts) != 2:
-                bot.reply_to(message, "Неверный формат класса. Попробуйте снова.")
-                return
-            class_name = parts[1].strip()
-            class_found = False
-            for class_id, class_info in data['classes'].items():
-                if class_info['name'] == class_name and class_info['teacher_id'] == user_id:
-                    class_found = True
-                    data['tests'][ct_state['test_id']]['class_id'] = class_id
-                    save_data(data)
-                    break
-            if not class_found:
-                bot.reply_to(message, "Класс не найден. Попробуйте снова.")
-                return
-            bot.reply_to(message, f"Тест ID: {ct_state['test_id']} успешно назначен классу {class_name}.",
-                         reply_markup=types.ReplyKeyboardRemove())
-            del user_states[user_id]['assigning_test']
-    except Exception as e:
-        bot.reply_to(message, f"Ошибка: {str(e)}")
-        if 'assigning_test' in user_states[user_id]:
-            del user_states[user_id]['assigning_test']
-
-@bot.message_handler(func=lambda message: message.text == "Мои тесты")
-def my_tests(message):
-    data = load_data()
-    user_id = str(message.from_user.id)
-    if user_id not in data['users'] or data['users'][user_id]['role'] != 'student':
-        bot.reply_to(message, "Эта команда доступна только для учеников.")
-        return
-    class_id = data['users'][user_id].get('class_id')
-    if not class_id:
-        bot.reply_to(message, "Вы не присоединены ни к одному классу.")
-        return
-    tests = [t for t in data['tests'].values() if t['class_id'] == class_id]
-    if not tests:
-        bot.reply_to(message, "У вас нет назначенных тестов.")
-        return
-    markup = types.ReplyKeyboardMarkup(one_time_keyboard=True)
-    for test in tests:
-        markup.add(types.KeyboardButton(f"Тест ID: {test['id']} - {test['topic']}"))
-    user_states[user_id] = {'taking_test': {'step': 1}}
-    bot.reply_to(message, "Выберите тест для прохождения:", reply_markup=markup)
-
-@bot.message_handler(func=lambda message: user_states.get(str(message.from_user.id), {}).get('taking_test'))
-def handle_taking_test_message(message):
-    data = load_data()
-    user_id = str(message.from_user.id)
-    state = user_states.get(user_id, {})
-    if 'taking_test' in state:
-        handle_taking_test(message, state, user_id, data)
-
-def handle_taking_test(message, state, user_id, data):
+def handle_taking_test(message, state, user_id):
     ts_state = state['taking_test']
     step = ts_state['step']
     try:
@@ -572,10 +787,10 @@ def handle_taking_test(message, state, user_id, data):
                 bot.reply_to(message, "Неверный формат теста. Попробуйте снова.")
                 return
             test_id = parts[1].split(" - ")[0].strip()
-            if test_id not in data['tests']:
+            test = store.get('tests', test_id)
+            if test is None:
                 bot.reply_to(message, "Тест не найден. Попробуйте снова.")
                 return
-            test = data['tests'][test_id]
             ts_state.update({
                 'test_id': test_id,
                 'current_question': 0,
@@ -588,7 +803,7 @@ def handle_taking_test(message, state, user_id, data):
             bot.reply_to(message, f"Вопрос 1:\n{first_question['question']}\n\n{options}", reply_markup=types.ReplyKeyboardRemove())
         elif step == 2:
             test_id = ts_state['test_id']
-            test = data['tests'][test_id]
+            test = store.get('tests', test_id)
             questions = test['questions']
             current_question = ts_state['current_question']
             question = questions[current_question]
@@ -597,6 +812,7 @@ def handle_taking_test(message, state, user_id, data):
                 if user_answer < 0 or user_answer >= len(question['options']):
                     raise ValueError()
                 ts_state['answers'].append(user_answer)
+                hint_text = ""
                 if user_answer != question['correct']:
                     ts_state['wrong_answers'].append({
                         'question': question['question'],
@@ -604,29 +820,38 @@ def handle_taking_test(message, state, user_id, data):
                         'correct_answer': question['options'][question['correct']],
                         'correct_index': question['correct']
                     })
+                    hint = hint_cache.cached(test, current_question, user_answer)
+                    if hint:
+                        hint_text = f"💡 Подсказка: {hint}\n\n"
+                    elif current_question + 1 < len(questions):
+                        # Подсказка ещё не готова - пришлём, когда сгенерируется
+                        runtime.submit(send_hint_when_ready(message.chat.id, test, current_question, user_answer))
                 ts_state['current_question'] += 1
                 if ts_state['current_question'] >= len(questions):
                     correct_answers = sum(
                         1 for i, q in enumerate(questions) if q['correct'] == ts_state['answers'][i]
                     )
                     total_questions = len(questions)
-                    save_test_result(data, user_id, test_id, correct_answers, total_questions, ts_state['wrong_answers'])
-                    wrong_info = ""
-                    if ts_state['wrong_answers']:
-                        wrong_info = "\n\nОшибки:\n"
-                        for idx, error in enumerate(ts_state['wrong_answers'], start=1):
-                            wrong_info += (
-                                f"{idx}. Вопрос: {error['question']}\n"
-                                f"   Ваш ответ: {error['user_answer']}\n"
-                                f"   Правильный ответ: {error['correct_answer']}\n"
-                            )
-                    bot.reply_to(message, f"Тест завершен!\nПравильных ответов: {correct_answers}/{total_questions}{wrong_info}",
-                                 reply_markup=types.ReplyKeyboardRemove())
+                    save_test_result(user_id, test_id, correct_answers, total_questions, ts_state['wrong_answers'],
+                                     ts_state['answers'])
+                    # Готовые подсказки сразу попадают в итог, остальные
+                    # запрашиваются параллельно и дописываются правкой сообщения
+                    mistakes = [(i, answer) for i, answer in enumerate(ts_state['answers'])
+                                if answer != questions[i]['correct']]
+                    hints = [hint_cache.cached(test, i, answer) for i, answer in mistakes]
+                    # Длинный итог идёт несколькими сообщениями, у каждого своя правка
+                    texts = render_test_summary(test, correct_answers, mistakes, hints,
+                                                split_test_summary(test, correct_answers, mistakes))
+                    message_ids = [bot.reply_to(message, texts[0], reply_markup=types.ReplyKeyboardRemove()).message_id]
+                    message_ids += [bot.send_message(message.chat.id, text).message_id for text in texts[1:]]
+                    if None in hints:
+                        runtime.submit(deliver_result_hints(message.chat.id, message_ids, test,
+                                                            correct_answers, mistakes, hints))
                     del user_states[user_id]['taking_test']
                     return
                 next_question = questions[ts_state['current_question']]
                 options = "\n".join([f"{i + 1}. {option}" for i, option in enumerate(next_question['options'])])
-                bot.reply_to(message, f"Вопрос {ts_state['current_question'] + 1}:\n{next_question['question']}\n\n{options}")
+                bot.reply_to(message, f"{hint_text}Вопрос {ts_state['current_question'] + 1}:\n{next_question['question']}\n\n{options}")
             except Exception as e:
                 bot.reply_to(message, f"Ошибка: {str(e)}")
                 del user_states[user_id]['taking_test']
@@ -634,61 +859,175 @@ def handle_taking_test(message, state, user_id, data):
         bot.reply_to(message, f"Ошибка: {str(e)}")
         del user_states[user_id]['taking_test']
 
-@bot.message_handler(func=lambda message: message.text == "Мои результаты")
+@router.text("Мои результаты")
 def my_results(message):
-    data = load_data()
     user_id = str(message.from_user.id)
-    if user_id not in data['users'] or data['users'][user_id]['role'] != 'student':
+    if store.get('users', user_id, {}).get('role') != 'student':
         bot.reply_to(message, "Эта команда доступна только для учеников.")
         return
-    results = [r for r in data['results'].values() if r['student_id'] == user_id]
+    results = store.find('results', student_id=user_id)
     if not results:
         bot.reply_to(message, "У вас пока нет результатов тестов.")
         return
-    response = "Ваши результаты:\n\n"
-    for result in results:
-        wrong_info = ""
-        if result.get('wrong_answers'):
-            wrong_info = "\nОшибки:\n"
-            for idx, error in enumerate(result['wrong_answers'], start=1):
-                wrong_info += (f"{idx}. Вопрос: {error['question']}\n"
-                               f"   Ваш ответ: {error['user_answer']}\n"
-                               f"   Правильный ответ: {error['correct_answer']}\n")
-        response += (f"Тест ID: {result['test_id']}\n"
-                     f"Правильных ответов: {result['correct_answers']}/{result['total_questions']}{wrong_info}\n\n")
-    bot.reply_to(message, response)
-
-def save_test_result(data, user_id, test_id, correct_answers, total_questions, wrong_answers):
-    result_id = str(len(data['results']) + 1)  # Генерация уникального ID
-    student_name = data['users'][user_id]['username']
-    teacher_id = data['tests'][test_id]['teacher_id']
-    data['results'][result_id] = {
-        'id': result_id,
-        'student_id': user_id,
-        'student_name': student_name,
-        'test_id': test_id,
-        'correct_answers': correct_answers,
-        'total_questions': total_questions,
-        'wrong_answers': wrong_answers,
-        'teacher_id': teacher_id
-    }
-    save_data(data)
-
-async def finalize_test_creation(user_id, topic, num_questions, difficulty, chat_id):
+    reports.send(bot, message.chat.id, user_id, 'my_results', reply_to_message_id=message.message_id)
+
+@reports.report('my_results')
+def load_my_results(user_id, arg):
+    return "Ваши результаты:", store.find('results', student_id=user_id), render_result_entry
+
+def render_result_entry(result):
+    wrong_info = ""
+    if result.get('wrong_answers'):
+        wrong_info = "\nОшибки:"
+        for idx, error in enumerate(result['wrong_answers'], start=1):
+            wrong_info += (f"\n{idx}. Вопрос: {error['question']}\n"
+                           f"   Ваш ответ: {error['user_answer']}\n"
+                           f"   Правильный ответ: {error['correct_answer']}")
+    return (f"Тест ID: {result['test_id']}\n"
+            f"Правильных ответов: {result['correct_answers']}/{result['total_questions']}{wrong_info}")
+
+def save_test_result(user_id, test_id, correct_answers, total_questions, wrong_answers, answers=None):
+    student = store.get('users', user_id)
+    test = store.get('tests', test_id)
+    # Результат и сводки сохраняются вместе или не сохраняются совсем
+    with store.transaction():
+        result_id = store.next_id('results')
+        result = {
+            'id': result_id,
+            'student_id': user_id,
+            'student_name': student['username'],
+            'test_id': test_id,
+            'correct_answers': correct_answers,
+            'total_questions': total_questions,
+            'wrong_answers': wrong_answers,
+            'answers': answers,
+            'teacher_id': test['teacher_id'],
+            'time': time.time()
+        }
+        store.put('results', result_id, result)
+        aggregates.record_result(store, result, student.get('class_id'), test.get('topic', 'Неизвестно'))
+    item_analytics.record(result, student.get('class_id'))
+
+def percent(part, whole):
+    return round(100 * part / whole) if whole else 0
+
+# Место под подсказку в итоге теста: ответ LLM ограничен 150 токенами
+HINT_RESERVE = 800
+
+def render_mistake(test, number, mistake, hint):
+    question_index, option_index = mistake
+    question = test['questions'][question_index]
+    text = (
+        f"{number}. Вопрос: {question['question']}\n"
+        f"   Ваш ответ: {question['options'][option_index]}\n"
+        f"   Правильный ответ: {question['options'][question['correct']]}\n"
+    )
+    if hint is None:
+        text += "   💡 Подсказка готовится...\n"
+    elif hint:
+        if len(hint) > HINT_RESERVE - 10:
+            hint = hint[:HINT_RESERVE - 11] + "…"
+        text += f"   💡 {hint}\n"
+    return text
+
+def summary_header(test, correct_answers, mistakes):
+    text = f"Тест завершен!\nПравильных ответов: {correct_answers}/{len(test['questions'])}"
+    return text + "\n\nОшибки:\n" if mistakes else text
+
+def split_test_summary(test, correct_answers, mistakes):
+    """
+    Номера ошибок для каждого сообщения итога. Сообщение рассчитано на
+    подсказки максимальной длины, поэтому при их появлении границы не
+    сдвигаются и текст не обрезается.
+    """
+    groups = [[]]
+    size = len(summary_header(test, correct_answers, mistakes))
+    for i, mistake in enumerate(mistakes):
+        cost = len(render_mistake(test, i + 1, mistake, '')) + HINT_RESERVE
+        if groups[-1] and size + cost > MESSAGE_LIMIT:
+            groups.append([])
+            size = 0
+        groups[-1].append(i)
+        size += cost
+    return groups
+
+def render_test_summary(test, correct_answers, mistakes, hints, groups):
+    """Тексты сообщений итога; hints[i] - подсказка к ошибке i, None - ещё готовится, '' - не удалась."""
+    texts = []
+    for number, group in enumerate(groups):
+        text = summary_header(test, correct_answers, mistakes) if number == 0 else ""
+        text += "".join(render_mistake(test, i + 1, mistakes[i], hints[i]) for i in group)
+        if len(text) > MESSAGE_LIMIT:
+            # Одна ошибка с очень длинным вопросом не помещается даже целиком
+            text = text[:text.rfind("\n", 0, MESSAGE_LIMIT - 1)] + "\n…"
+        texts.append(text)
+    return texts
+
+async def deliver_result_hints(chat_id, message_ids, test, correct_answers, mistakes, hints):
+    """Запрашивает недостающие подсказки параллельно и дописывает каждую в своё сообщение итога."""
+    groups = split_test_summary(test, correct_answers, mistakes)
+    texts = render_test_summary(test, correct_answers, mistakes, hints, groups)
+    messages = [ProgressMessage(chat_id, message_id, text) for message_id, text in zip(message_ids, texts)]
+    missing = [i for i, hint in enumerate(hints) if hint is None]
+    async for i, hint in hint_cache.get_many(test, [mistakes[i] for i in missing], RESULT_HINT_CONCURRENCY):
+        hints[missing[i]] = hint or ''
+        for message, text in zip(messages, render_test_summary(test, correct_answers, mistakes, hints, groups)):
+            message.update(text)
+    texts = render_test_summary(test, correct_answers, mistakes, hints, groups)
+    await asyncio.gather(*(message.finish(text) for message, text in zip(messages, texts)))
+
+async def send_hint_when_ready(chat_id, test, question_index, option_index):
+    hint = await hint_cache.get(test, question_index, option_index)
+    if hint:
+        await send_message_async(chat_id, f"💡 Подсказка к вопросу {question_index + 1}: {hint}")
+
+async def generate_test_with_progress(progress, topic, num_questions, difficulty, seed):
+    """Потоковая генерация: готовые вопросы сразу появляются в сообщении progress."""
+    received = list(seed)
+
+    async def on_question(question):
+        received.append(question)
+        q_list = "\n".join([f"{i+1}. {q['question']}" for i, q in enumerate(received)])
+        progress.update(f"⏳ Генерирую тест «{topic}»: {len(received)}/{num_questions}\n\n{q_list}")
+
+    await progress.start(f"⏳ Генерирую тест «{topic}»...")
+    return await generate_test_sharded(topic, num_questions, difficulty, os.getenv('YANDEX_API_KEY'),
+                                       os.getenv('YANDEX_FOLDER_ID'), on_question=on_question, seed=seed)
+
+def save_generated_test(user_id, topic, difficulty, questions):
+    test_id = store.next_id('tests')
+    store.put('tests', test_id, {
+        'id': test_id,
+        'topic': topic,
+        'difficulty': difficulty,
+        'questions': questions,
+        'teacher_id': user_id,
+        'class_id': None
+    })
+    return test_id
+
+async def finalize_test_creation(user_id, topic, num_questions, difficulty, chat_id, use_cache=True):
+    progress = None
     try:
-        generated_test = await generate_test(topic, num_questions, difficulty, os.getenv('YANDEX_API_KEY'), os.getenv('YANDEX_FOLDER_ID'))
+        # use_cache=False - учитель попросил новые вопросы
+        generated_test = await run_blocking(test_cache.get, topic, num_questions, difficulty) if use_cache else None
+        if generated_test is None:
+            # Просьба сгенерировать заново - значит, и вопросы из банка не подходят
+            banked = await run_blocking(question_bank.take, topic, difficulty, num_questions) if use_cache else []
+            if len(banked) >= num_questions:
+                generated_test = banked
+            elif STREAM_GENERATION:
+                progress = ProgressMessage(chat_id)
+                generated_test = await generate_test_with_progress(progress, topic, num_questions, difficulty, banked)
+            else:
+                generated_test = await generate_test_sharded(topic, num_questions, difficulty, os.getenv('YANDEX_API_KEY'), os.getenv('YANDEX_FOLDER_ID'), seed=banked)
+            if generated_test:
+                await run_blocking(question_bank.add, topic, difficulty, generated_test[len(banked):])
+            if generated_test and len(generated_test) >= 5:
+                await run_blocking(test_cache.put, topic, num_questions, difficulty, generated_test)
         if generated_test and len(generated_test) >= 5:
-            data = load_data()
-            test_id = str(len(data['tests']) + 1)
-            data['tests'][test_id] = {
-                'id': test_id,
-                'topic': topic,
-                'difficulty': difficulty,
-                'questions': generated_test,
-                'teacher_id': user_id,
-                'class_id': None
-            }
-            save_data(data)
+            test_id = await run_blocking(save_generated_test, user_id, topic, difficulty, generated_test)
+            hint_cache.schedule_precompute(test_id)
             q_list = "\n".join([f"{i+1}. {q['question']}" for i, q in enumerate(generated_test)])
             response = (f"✅ Тест успешно создан!\n"
                         f"ID: {test_id}\n"
@@ -698,88 +1037,44 @@ async def finalize_test_creation(user_id, topic, num_questions, difficulty, chat
             response = "Не удалось сгенерировать тест. Попробуйте изменить параметры."
     except Exception as e:
         response = f"Ошибка при создании теста: {str(e)}"
-    bot.send_message(chat_id, response)
-    
-async def generate_test(topic: str, num_questions: int, difficulty: str, api_key: str, folder_id: str) -> Optional[list]:
-    prompt = f"""
-    Сгенерируй тест по теме "{topic}". 
-    Количество вопросов: {num_questions}. Уровень сложности: {difficulty}.
-    Формат ответа: строго JSON с полем "questions" (список вопросов).
-    Каждый вопрос должен содержать:
-    - "question" (текст вопроса)
-    - "options" (список из 4 строк)
-    - "correct" (индекс правильного ответа: 0-3)
-    - "explanation" (краткое объяснение, почему этот ответ правильный)
-    """
-    url = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
-    headers = {
-        "Authorization": f"Api-Key {api_key}",
-        "x-folder-id": folder_id,
-        "Content-Type": "application/json"
-    }
-    data = {
-        "modelUri": f"gpt://{folder_id}/yandexgpt-lite",
-        "completionOptions": {
-            "stream": False,
-            "temperature": 0.7,  # Повышаем температуру для более разнообразных ответов
-            "maxTokens": 2500
-        },
-        "messages": [
-            {
-                "role": "system",
-                "text": "Ты - опытный преподаватель и эксперт в создании учебных тестов. Твоя задача - создавать тесты по любой указанной теме."
-            },
-            {"role": "user", "text": prompt}
-        ]
-    }
+    if progress is not None and progress.message_id is not None:
+        await progress.finish(response)
+    else:
+        await send_message_async(chat_id, response)
     
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.post(url, headers=headers, json=data, timeout=40) as resp:
-                if resp.status != 200:
-                    print(f"API Error: HTTP {resp.status}")
-                    return None
-                result = await resp.json()
-                alternatives = result.get('result', {}).get('alternatives', [{}])
-                text = alternatives[0].get('message', {}).get('text', "") if alternatives else ""
-                start_idx = text.find('{')
-                end_idx = text.rfind('}') + 1
-                json_str = text[start_idx:end_idx] if start_idx != -1 and end_idx != 0 else text
-                try:
-                    parsed = json.loads(json_str)
-                    questions = parsed.get('questions', [])
-                    validated = []
-                    for q in questions:
-                        q = {k.lower(): v for k, v in q.items()}
-                        if not all(k in q for k in ['question', 'options', 'correct']):
-                            continue
-                        if not isinstance(q['question'], str) or \
-                           not isinstance(q['options'], list) or \
-                           not isinstance(q['correct'], int):
-                            continue
-                        if len(q['question']) < 5 or \
-                           len(q['options']) != 4 or \
-                           q['correct'] < 0 or \
-                           q['correct'] > 3:
-                            continue
-                        if len(set(q['options'])) != 4:
-                            continue
-                        correct_index = q['correct']
-                        if q['options'][correct_index] in [opt for i, opt in enumerate(q['options']) if i != correct_index]:
-                            continue
-                        validated.append({
-                            'question': q['question'],
-                            'options': q['options'],
-                            'correct': q['correct'],
-                            'explanation': q.get('explanation', '')
-                        })
-                    return validated[:num_questions]
-                except json.JSONDecodeError:
-                    print("Failed to parse JSON response")
-                    return None
-        except Exception as e:
-            print(f"Connection error: {str(e)}")
-            return None
+@bot.message_handler(func=lambda message: True)
+def dispatch_message(message):
+    router.dispatch(message)
+
+# polling - getUpdates в цикле; webhook - HTTP-сервер в общем цикле событий
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+# Публичный адрес для setWebhook; без него сервер только слушает (локальная проверка)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+# Без заданного секрета генерируется случайный: сервер не принимает
+# обновления без заголовка с ним, иначе любой мог бы подделать from.id.
+# Для локальной проверки секрет нужно задать явно
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+
+def run_webhook():
+    server = WebhookServer(bot, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+    runtime.submit(server.start()).result()
+    if WEBHOOK_URL:
+        bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        runtime.submit(server.stop()).result(timeout=5)
 
 if __name__ == "__main__":
-    bot.infinity_polling()
\ No newline at end of file
+    start_metrics()
+    if BOT_MODE == 'webhook':
+        run_webhook()
+    else:
+        bot.remove_webhook()
+        bot.infinity_polling()
\ No newline at end of file
@@ -0,0 +1,680 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Any, Iterator, Optional, List, Tuple
+
+from metrics import registry, BYTES_BUCKETS
+
+try:
+    import fcntl
+except ImportError:  # Windows: защиты от второго процесса нет
+    fcntl = None
+
+# Коллекции, из которых состоит bot_data.json (sessions - состояния диалогов,
+# student_stats и class_stats - сводки результатов, см. aggregates.py,
+# questions - банк вопросов, см. question_bank.py, sequences - последние
+# выданные ID коллекций, см. Storage.next_id)
+COLLECTIONS = ('users', 'classes', 'tests', 'results', 'sessions', 'student_stats', 'class_stats', 'questions',
+               'sequences')
+
+# Индексы, по которым обработчики ищут записи: каждый - набор полей,
+# значения которых должны совпасть (поля перечислены в алфавитном порядке)
+INDEXES = {
+    'users': [('class_id',)],
+    'classes': [('teacher_id',), ('access_code',), ('name', 'teacher_id')],
+    'tests': [('teacher_id',), ('class_id',)],
+    'results': [('student_id',), ('test_id',), ('teacher_id',)],
+    'questions': [('difficulty', 'topic_key')],
+}
+
+STORE_LOAD_SECONDS = registry.histogram('store_load_seconds', 'Загрузка данных при запуске')
+STORE_WRITE_SECONDS = registry.histogram('store_write_seconds', 'Запись данных на диск (journal, snapshot, sqlite)')
+STORE_WRITE_BYTES = registry.histogram('store_write_bytes', 'Объём одной записи на диск', BYTES_BUCKETS)
+# Запись на диск для sqlite - это COMMIT: неявный у одиночного put()/delete()
+# или завершающий транзакцию, поэтому kind='sqlite' сравним с kind='journal'
+
+
+def indexed_fields(collection: str) -> Tuple[str, ...]:
+    """Все поля коллекции, входящие хотя бы в один индекс."""
+    fields = []
+    for spec in INDEXES.get(collection, []):
+        fields.extend(f for f in spec if f not in fields)
+    return tuple(fields)
+
+
+def index_spec(collection: str, criteria: Dict[str, Any]) -> Tuple[str, ...]:
+    spec = tuple(sorted(criteria))
+    if spec not in INDEXES.get(collection, []):
+        raise KeyError(f"Нет индекса {collection}{spec}")
+    return spec
+
+
+def empty_data() -> Dict[str, Any]:
+    return {name: {} for name in COLLECTIONS}
+
+
+def read_snapshot(path: str) -> Dict[str, Any]:
+    """Читает снимок данных (формат bot_data.json)."""
+    if not os.path.exists(path):
+        return empty_data()
+    with open(path, 'r', encoding='utf-8') as f:
+        try:
+            data = json.load(f)
+        except json.JSONDecodeError:
+            print("Ошибка: Невозможно декодировать JSON. Создаю новый файл данных.")
+            return empty_data()
+    # Проверка наличия обязательных полей
+    for name in COLLECTIONS:
+        data.setdefault(name, {})
+    return data
+
+
+def write_snapshot(path: str, text: str):
+    """Атомарно записывает снимок: во временный файл, затем rename."""
+    # Уникальное имя: кэш тестов могут одновременно сохранять несколько процессов
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                    dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            if os.path.exists(path):
+                # mkstemp создаёт файл с правами 0600 - сохраняем права прежнего снимка
+                os.chmod(tmp_path, os.stat(path).st_mode & 0o777)
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if hasattr(os, 'O_DIRECTORY'):
+        # rename становится устойчивым к сбою питания только после fsync каталога
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class Storage:
+    """
+    Интерфейс хранилища. Записи - словари, которые хранятся целиком;
+    после изменения записи её нужно сохранить через put().
+    """
+
+    def open(self):
+        return self
+
+    def close(self):
+        pass
+
+    def get(self, collection: str, key: str, default=None):
+        raise NotImplementedError
+
+    def values(self, collection: str) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def items(self, collection: str) -> List[Tuple[str, Dict[str, Any]]]:
+        raise NotImplementedError
+
+    def count(self, collection: str) -> int:
+        raise NotImplementedError
+
+    def find_items(self, collection: str, **criteria) -> List[Tuple[str, Dict[str, Any]]]:
+        """
+        Пары (ключ, запись), у которых поля равны criteria, например
+        find_items('classes', teacher_id='1', name='7A'). Набор полей
+        должен совпадать с одним из индексов в INDEXES.
+        """
+        raise NotImplementedError
+
+    def find(self, collection: str, **criteria) -> List[Dict[str, Any]]:
+        return [record for _, record in self.find_items(collection, **criteria)]
+
+    def iter_find(self, collection: str, **criteria) -> Iterator[Dict[str, Any]]:
+        """Как find(), но отдаёт записи по одной, не собирая их в список."""
+        return iter(self.find(collection, **criteria))
+
+    def find_one(self, collection: str, **criteria) -> Optional[Dict[str, Any]]:
+        records = self.find(collection, **criteria)
+        return records[0] if records else None
+
+    def put(self, collection: str, key: str, value: Dict[str, Any]):
+        raise NotImplementedError
+
+    def delete(self, collection: str, key: str):
+        raise NotImplementedError
+
+    def transaction(self):
+        """
+        Контекстный менеджер для группы чтений и записей, которую не
+        перемешают с записями других потоков: изменения сохраняются все
+        вместе или, при исключении, не сохраняются вовсе. Вложенные
+        транзакции входят во внешнюю.
+        """
+        raise NotImplementedError
+
+    def disk_size(self) -> int:
+        """Сколько байт данные занимают на диске."""
+        raise NotImplementedError
+
+    def next_id(self, collection: str) -> str:
+        """
+        Следующий ID записи коллекции. Последовательность только растёт,
+        поэтому ID не повторяются и после удаления записей. Для старых
+        данных она начинается с наибольшего числового ключа коллекции.
+        """
+        with self.transaction():
+            sequence = self.get('sequences', collection)
+            if sequence is None:
+                last = max((int(key) for key, _ in self.items(collection) if key.isdigit()), default=0)
+            else:
+                last = sequence['value']
+            self.put('sequences', collection, {'value': last + 1})
+        return str(last + 1)
+
+
+class JournalStorage(Storage):
+    """
+    Резидентное хранилище: данные загружаются один раз при старте и
+    обслуживаются из памяти. Каждое изменение дописывается в журнал
+    (append-only), журнал сбрасывается на диск с fsync пачками, а в фоне
+    периодически сворачивается в снимок bot_data.json. Данные держит
+    один процесс: второй процесс с теми же файлами не откроется.
+    """
+
+    def __init__(self, snapshot_path: str, journal_path: Optional[str] = None,
+                 flush_interval: float = 0.2, compact_threshold: int = 4 * 1024 * 1024):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path or os.path.splitext(snapshot_path)[0] + '.journal'
+        self.flush_interval = flush_interval
+        self.compact_threshold = compact_threshold
+        self._data = empty_data()
+        # Вторичные индексы: (коллекция, поле) -> значение -> ключи записей.
+        # Значения индексированных полей запоминаются отдельно, потому что
+        # обработчики меняют запись на месте до вызова put()
+        self._index: Dict[Tuple[str, str], Dict[Any, Dict[str, None]]] = {}
+        self._indexed_values: Dict[str, Dict[str, tuple]] = {}
+        self._pending: List[str] = []
+        self._journal = None
+        self._journal_size = 0
+        # _lock защищает данные в памяти и очередь записей,
+        # _io_lock - файл журнала и снимок
+        self._lock = threading.RLock()
+        self._io_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flusher = None
+        self._lock_file = None
+        # Откат открытой транзакции: (коллекция, ключ, прежняя запись)
+        self._undo: Optional[List[Tuple[str, str, Optional[Dict[str, Any]]]]] = None
+        self._tx_entries: List[str] = []
+
+    # --- Жизненный цикл ---
+
+    def _lock_files(self):
+        if fcntl is None:
+            return
+        self._lock_file = open(self.journal_path + '.lock', 'w')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            self._lock_file = None
+            raise RuntimeError(f"{self.snapshot_path} уже открыт другим процессом. "
+                               f"Для нескольких процессов используйте STORAGE_BACKEND=sqlite")
+
+    def open(self):
+        self._lock_files()
+        started = time.perf_counter()
+        self._data = read_snapshot(self.snapshot_path)
+        # .old остаётся, если процесс упал посреди сворачивания журнала
+        old_path = self.journal_path + '.old'
+        for path in (old_path, self.journal_path):
+            self._replay(path)
+        if os.path.exists(old_path):
+            # Изменения из .old есть только в нём: сразу сохраняем их в снимок,
+            # иначе следующее сворачивание перезапишет .old текущим журналом.
+            # Журнал остаётся - его повтор поверх нового снимка ничего не меняет
+            write_snapshot(self.snapshot_path, json.dumps(self._data, ensure_ascii=False, indent=2))
+            os.remove(old_path)
+        self._cut_torn_tail(self.journal_path)
+        self._build_indexes()
+        STORE_LOAD_SECONDS.observe(time.perf_counter() - started, backend='json')
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        self._journal_size = os.path.getsize(self.journal_path)
+        self._flusher = threading.Thread(target=self._flush_loop, name='store-flusher', daemon=True)
+        self._flusher.start()
+        return self
+
+    def close(self):
+        self._stop.set()
+        if self._flusher:
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
+        if self._journal and self._journal_size:
+            self.compact()
+        if self._journal:
+            self._journal.close()
+            self._journal = None
+        if self._lock_file:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def disk_size(self) -> int:
+        return sum(os.path.getsize(path) for path in (self.snapshot_path, self.journal_path, self.journal_path + '.old')
+                   if os.path.exists(path))
+
+    # --- Чтение ---
+
+    def get(self, collection: str, key: str, default=None):
+        return self._data[collection].get(key, default)
+
+    def values(self, collection: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self._data[collection].values())
+
+    def items(self, collection: str) -> List[Tuple[str, Dict[str, Any]]]:
+        with self._lock:
+            return list(self._data[collection].items())
+
+    def count(self, collection: str) -> int:
+        return len(self._data[collection])
+
+    def find_items(self, collection: str, **criteria) -> List[Tuple[str, Dict[str, Any]]]:
+        spec = index_spec(collection, criteria)
+        value = tuple(criteria[field] for field in spec)
+        with self._lock:
+            keys = self._index[(collection, spec)].get(value, {})
+            records = self._data[collection]
+            return [(key, records[key]) for key in keys]
+
+    # --- Запись ---
+
+    def put(self, collection: str, key: str, value: Dict[str, Any]):
+        """Сохраняет запись целиком. В журнал попадает только она."""
+        with self._lock:
+            self._remember(collection, key)
+            self._data[collection][key] = value
+            self._reindex(collection, key, value)
+            self._append({'op': 'put', 'c': collection, 'k': key, 'v': value})
+
+    def delete(self, collection: str, key: str):
+        with self._lock:
+            self._remember(collection, key)
+            if self._data[collection].pop(key, None) is not None:
+                self._reindex(collection, key, None)
+                self._append({'op': 'del', 'c': collection, 'k': key})
+
+    # --- Транзакции ---
+
+    @contextmanager
+    def transaction(self):
+        """
+        Держит блокировку записи до конца блока и пишет все изменения
+        одной строкой журнала, поэтому после сбоя транзакция либо
+        восстановится целиком, либо не восстановится совсем. При
+        исключении откатываются put() и delete(); запись, изменённую на
+        месте, внутри транзакции нужно менять в копии.
+        """
+        with self._lock:
+            if self._undo is not None:
+                yield
+                return
+            self._undo, self._tx_entries = [], []
+            try:
+                yield
+            except BaseException:
+                for collection, key, old in reversed(self._undo):
+                    if old is None:
+                        self._data[collection].pop(key, None)
+                    else:
+                        self._data[collection][key] = old
+                    self._reindex(collection, key, old)
+                raise
+            else:
+                if len(self._tx_entries) == 1:
+                    self._pending.append(self._tx_entries[0] + '\n')
+                elif self._tx_entries:
+                    self._pending.append('{"op":"tx","ops":[' + ','.join(self._tx_entries) + ']}\n')
+            finally:
+                self._undo, self._tx_entries = None, []
+
+    def _remember(self, collection: str, key: str):
+        if self._undo is not None:
+            self._undo.append((collection, key, self._data[collection].get(key)))
+
+    # --- Индексы ---
+
+    def _build_indexes(self):
+        self._index = {(c, spec): {} for c, specs in INDEXES.items() for spec in specs}
+        self._indexed_values = {c: {} for c in INDEXES}
+        for collection in INDEXES:
+            for key, record in self._data[collection].items():
+                self._reindex(collection, key, record)
+
+    def _reindex(self, collection: str, key: str, record: Optional[Dict[str, Any]]):
+        specs = INDEXES.get(collection)
+        if not specs:
+            return
+        old = self._indexed_values[collection].pop(key, None)
+        new = None
+        if record is not None:
+            new = tuple(tuple(record.get(field) for field in spec) for spec in specs)
+        for i, spec in enumerate(specs):
+            index = self._index[(collection, spec)]
+            # Неизменившиеся значения не трогаем, чтобы сохранить порядок вставки
+            if old is not None and (new is None or old[i] != new[i]):
+                bucket = index.get(old[i], {})
+                bucket.pop(key, None)
+                if not bucket:
+                    index.pop(old[i], None)
+            if new is not None and (old is None or old[i] != new[i]):
+                index.setdefault(new[i], {})[key] = None
+        if new is not None:
+            self._indexed_values[collection][key] = new
+
+    def _append(self, entry: Dict[str, Any]):
+        # Сериализуем сразу, чтобы последующие изменения объекта
+        # без вызова put() не попали в журнал
+        line = json.dumps(entry, ensure_ascii=False, separators=(',', ':'))
+        if self._undo is not None:
+            self._tx_entries.append(line)
+        else:
+            self._pending.append(line + '\n')
+
+    # --- Журнал и снимок ---
+
+    def _apply(self, entry: Dict[str, Any]):
+        if entry['op'] == 'tx':
+            for op in entry['ops']:
+                self._apply(op)
+            return
+        collection = self._data.setdefault(entry['c'], {})
+        if entry['op'] == 'put':
+            collection[entry['k']] = entry['v']
+        elif entry['op'] == 'del':
+            collection.pop(entry['k'], None)
+
+    def _replay(self, path: str):
+        if not os.path.exists(path):
+            return
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    self._apply(json.loads(line))
+                except (json.JSONDecodeError, KeyError):
+                    # Оборванная при сбое последняя строка
+                    print(f"Пропущена повреждённая запись журнала {path}")
+
+    @staticmethod
+    def _cut_torn_tail(path: str):
+        """
+        Отрезает недописанную при сбое последнюю строку журнала. Иначе
+        следующая запись приклеится к ней и пропадёт при повторе вместе с ней.
+        """
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb+') as f:
+            end = pos = f.seek(0, os.SEEK_END)
+            cut = 0
+            while pos > 0:
+                step = min(64 * 1024, pos)
+                f.seek(pos - step)
+                newline = f.read(step).rfind(b'\n')
+                if newline >= 0:
+                    cut = pos - step + newline + 1
+                    break
+                pos -= step
+            if cut < end:
+                f.truncate(cut)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _write_pending(self, pending: List[str]):
+        if not pending:
+            return
+        started = time.perf_counter()
+        chunk = ''.join(pending)
+        self._journal.write(chunk)
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        size = len(chunk.encode('utf-8'))
+        self._journal_size += size
+        STORE_WRITE_SECONDS.observe(time.perf_counter() - started, kind='journal')
+        STORE_WRITE_BYTES.observe(size, kind='journal')
+
+    def flush(self):
+        """Сбрасывает накопленные записи в журнал одним fsync."""
+        with self._io_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if self._journal:
+                self._write_pending(pending)
+
+    def compact(self):
+        """Сворачивает журнал в снимок bot_data.json."""
+        with self._io_lock:
+            # Под блокировкой данных - только копия коллекций и смена журнала;
+            # сериализация идёт без неё и не задерживает обработчики
+            with self._lock:
+                pending, self._pending = self._pending, []
+                data = {name: dict(records) for name, records in self._data.items()}
+            # Всё, что вошло в снимок, сначала фиксируем в старом журнале,
+            # новые изменения пойдут уже в свежий
+            self._write_pending(pending)
+            self._journal.close()
+            os.replace(self.journal_path, self.journal_path + '.old')
+            self._journal = open(self.journal_path, 'a', encoding='utf-8')
+            self._journal_size = 0
+            text = self._serialize(data)
+            started = time.perf_counter()
+            write_snapshot(self.snapshot_path, text)
+            STORE_WRITE_SECONDS.observe(time.perf_counter() - started, kind='snapshot')
+            STORE_WRITE_BYTES.observe(len(text.encode('utf-8')), kind='snapshot')
+            os.remove(self.journal_path + '.old')
+
+    def _serialize(self, data: Dict[str, Dict[str, Any]]) -> str:
+        # Обработчик может менять запись на месте прямо во время обхода.
+        # Снимок с более новой записью тоже верен: её put лежит в новом журнале
+        for _ in range(3):
+            try:
+                return json.dumps(data, ensure_ascii=False, indent=2)
+            except RuntimeError:
+                continue
+        with self._lock:
+            return json.dumps(data, ensure_ascii=False, indent=2)
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+                if self._journal_size > self.compact_threshold:
+                    self.compact()
+            except Exception as e:
+                print(f"Ошибка записи журнала: {str(e)}")
+
+
+class SqliteStorage(Storage):
+    """
+    Хранилище в SQLite (режим WAL). Каждая коллекция - отдельная таблица:
+    запись лежит в колонке data как JSON, а поля из INDEXES вынесены
+    в колонки с индексами, поэтому find() не сканирует таблицу. Базу
+    могут одновременно открыть несколько процессов: транзакции начинаются
+    с BEGIN IMMEDIATE и ждут друг друга до busy_timeout.
+    """
+
+    def __init__(self, path: str, busy_timeout: float = 30):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._conn = None
+        self._lock = threading.RLock()
+        self._tx_depth = 0
+        self._tx_bytes = 0
+
+    def open(self):
+        started = time.perf_counter()
+        self._conn = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        for collection in COLLECTIONS:
+            fields = indexed_fields(collection)
+            columns = ''.join(f', {field} TEXT' for field in fields)
+            self._conn.execute(
+                f'CREATE TABLE IF NOT EXISTS {collection} (id TEXT PRIMARY KEY, data TEXT NOT NULL{columns})'
+            )
+            # Базы, созданные со старым набором индексов, догоняем до текущего
+            existing = {row[1] for row in self._conn.execute(f'PRAGMA table_info({collection})')}
+            for field in fields:
+                if field not in existing:
+                    self._conn.execute(f'ALTER TABLE {collection} ADD COLUMN {field} TEXT')
+                    self._conn.execute(
+                        f"UPDATE {collection} SET {field} = json_extract(data, '$.{field}')"
+                    )
+            for spec in INDEXES.get(collection, []):
+                self._conn.execute(
+                    f'CREATE INDEX IF NOT EXISTS idx_{collection}_{"_".join(spec)} '
+                    f'ON {collection} ({", ".join(spec)})'
+                )
+        STORE_LOAD_SECONDS.observe(time.perf_counter() - started, backend='sqlite')
+        return self
+
+    def close(self):
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+    def disk_size(self) -> int:
+        # В режиме WAL свежие изменения лежат в -wal до контрольной точки
+        return sum(os.path.getsize(path) for path in (self.path, self.path + '-wal') if os.path.exists(path))
+
+    def _query(self, sql: str, params: tuple = ()) -> List[tuple]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def get(self, collection: str, key: str, default=None):
+        rows = self._query(f'SELECT data FROM {collection} WHERE id = ?', (key,))
+        return json.loads(rows[0][0]) if rows else default
+
+    def values(self, collection: str) -> List[Dict[str, Any]]:
+        rows = self._query(f'SELECT data FROM {collection} ORDER BY rowid')
+        return [json.loads(row[0]) for row in rows]
+
+    def items(self, collection: str) -> List[Tuple[str, Dict[str, Any]]]:
+        rows = self._query(f'SELECT id, data FROM {collection} ORDER BY rowid')
+        return [(row[0], json.loads(row[1])) for row in rows]
+
+    def count(self, collection: str) -> int:
+        return self._query(f'SELECT COUNT(*) FROM {collection}')[0][0]
+
+    def find_items(self, collection: str, **criteria) -> List[Tuple[str, Dict[str, Any]]]:
+        spec = index_spec(collection, criteria)
+        conditions = ' AND '.join(
+            f'{field} IS NULL' if criteria[field] is None else f'{field} = ?' for field in spec
+        )
+        params = tuple(criteria[field] for field in spec if criteria[field] is not None)
+        rows = self._query(f'SELECT id, data FROM {collection} WHERE {conditions} ORDER BY rowid', params)
+        return [(row[0], json.loads(row[1])) for row in rows]
+
+    def iter_find(self, collection: str, batch: int = 500, **criteria) -> Iterator[Dict[str, Any]]:
+        # Порциями по rowid: блокировка держится только на время одной порции
+        spec = index_spec(collection, criteria)
+        conditions = ''.join(
+            f' AND {field} IS NULL' if criteria[field] is None else f' AND {field} = ?' for field in spec
+        )
+        params = tuple(criteria[field] for field in spec if criteria[field] is not None)
+        last = 0
+        while True:
+            rows = self._query(
+                f'SELECT rowid, data FROM {collection} WHERE rowid > ?{conditions} ORDER BY rowid LIMIT ?',
+                (last,) + params + (batch,)
+            )
+            for row in rows:
+                yield json.loads(row[1])
+            if len(rows) < batch:
+                return
+            last = rows[-1][0]
+
+    def _upsert(self, collection: str, key: str, value: Dict[str, Any]) -> int:
+        fields = indexed_fields(collection)
+        columns = ''.join(f', {field}' for field in fields)
+        placeholders = ', ?' * len(fields)
+        updates = ''.join(f', {field} = excluded.{field}' for field in fields)
+        data = json.dumps(value, ensure_ascii=False)
+        # ON CONFLICT ... DO UPDATE сохраняет rowid, а значит и порядок вставки
+        self._conn.execute(
+            f'INSERT INTO {collection} (id, data{columns}) VALUES (?, ?{placeholders}) '
+            f'ON CONFLICT(id) DO UPDATE SET data = excluded.data{updates}',
+            (key, data) + tuple(value.get(field) for field in fields)
+        )
+        return len(data.encode('utf-8'))
+
+    def _write(self, fn, *args) -> None:
+        """Изменение вне транзакции сразу фиксируется - его время и объём идут в метрики."""
+        with self._lock:
+            if self._tx_depth:
+                self._tx_bytes += fn(*args) or 0
+                return
+            started = time.perf_counter()
+            size = fn(*args) or 0
+        STORE_WRITE_SECONDS.observe(time.perf_counter() - started, kind='sqlite')
+        STORE_WRITE_BYTES.observe(size, kind='sqlite')
+
+    def _delete(self, collection: str, key: str):
+        self._conn.execute(f'DELETE FROM {collection} WHERE id = ?', (key,))
+
+    def put(self, collection: str, key: str, value: Dict[str, Any]):
+        self._write(self._upsert, collection, key, value)
+
+    def delete(self, collection: str, key: str):
+        self._write(self._delete, collection, key)
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            if self._tx_depth:
+                self._tx_depth += 1
+                try:
+                    yield
+                finally:
+                    self._tx_depth -= 1
+                return
+            # IMMEDIATE сразу берёт блокировку записи, и параллельная
+            # транзакция другого процесса ждёт, а не падает при COMMIT
+            self._conn.execute('BEGIN IMMEDIATE')
+            self._tx_depth = 1
+            self._tx_bytes = 0
+            try:
+                yield
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            else:
+                started = time.perf_counter()
+                self._conn.execute('COMMIT')
+                if self._tx_bytes:
+                    STORE_WRITE_SECONDS.observe(time.perf_counter() - started, kind='sqlite')
+                    STORE_WRITE_BYTES.observe(self._tx_bytes, kind='sqlite')
+            finally:
+                self._tx_depth = 0
+
+    def import_data(self, data: Dict[str, Any]):
+        """Загружает данные в формате bot_data.json одной транзакцией."""
+        with self.transaction():
+            for collection in COLLECTIONS:
+                for key, value in data.get(collection, {}).items():
+                    self._upsert(collection, key, value)
+
+
+def open_storage(backend: str, data_file: str, sqlite_file: str) -> Storage:
+    """Создаёт и открывает хранилище по имени бэкенда: json или sqlite."""
+    if backend == 'sqlite':
+        return SqliteStorage(sqlite_file).open()
+    if backend == 'json':
+        return JournalStorage(data_file).open()
+    raise ValueError(f"Неизвестный бэкенд хранилища: {backend}")
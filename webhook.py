@@ -0,0 +1,56 @@
+import hmac
+import json
+from typing import Optional
+
+from aiohttp import web
+from telebot import types
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+    """
+    HTTP-сервер для приёма обновлений Telegram через webhook. Работает в
+    общем цикле событий (async_runtime) рядом с клиентом LLM. Обновление
+    передаётся боту сразу, ответ Telegram отправляется не дожидаясь
+    обработчиков. Запросы без секретного заголовка отклоняются; локально
+    сервер проверяется POST-запросом с JSON обновления и этим заголовком.
+    """
+
+    def __init__(self, bot, secret: str, host: str = '127.0.0.1', port: int = 8080,
+                 path: str = '/webhook'):
+        if not secret:
+            raise ValueError("Webhook-серверу нужен секретный токен")
+        self.bot = bot
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self.app = web.Application()
+        self.app.router.add_post(path, self.handle_update)
+        self._runner: Optional[web.AppRunner] = None
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret):
+            return web.Response(status=403)
+        try:
+            update = types.Update.de_json(await request.json())
+        except (json.JSONDecodeError, ValueError, KeyError, TypeError) as e:
+            print(f"Некорректное обновление: {str(e)}")
+            return web.Response(status=400)
+        # Обработчики бота синхронные и выполняются в пуле потоков; если
+        # очередь пользователя переполнена, Telegram повторит доставку позже
+        if not self.bot.submit_update(update, block=False):
+            return web.Response(status=503)
+        return web.Response()
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        print(f"Webhook-сервер слушает {self.host}:{self.port}{self.path}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
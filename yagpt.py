@@ -1,8 +1,78 @@
-import json
-import aiohttp
-from typing import Optional
+import asyncio
+import math
+import os
+from typing import Optional, Dict, Any, Callable, Awaitable, List, Tuple
 
-async def generate_hint(question: str, answer: str, api_key: str, folder_id: str) -> Optional[str]:
+from llm_scheduler import INTERACTIVE
+from llm_providers import completion_alternative, completion_text, router
+from question_parser import is_near_duplicate, parse_questions, QuestionStreamParser
+
+# Крупные тесты генерируются несколькими параллельными запросами
+# по TEST_SHARD_SIZE вопросов; недостающие вопросы добираются до TOPUP_ROUNDS раз
+TEST_SHARD_SIZE = int(os.getenv('TEST_SHARD_SIZE', '5'))
+TOPUP_ROUNDS = 2
+
+# Статус ответа, обрезанного по maxTokens
+TRUNCATED = 'ALTERNATIVE_STATUS_TRUNCATED_FINAL'
+
+
+class TokenBudget:
+    """
+    maxTokens для генерации теста. Оценка токенов на вопрос уточняется
+    скользящим средним по usage ответов и умножается на число вопросов
+    с запасом: маленький тест не резервирует лишнего, большой не
+    обрезается на середине.
+    """
+
+    def __init__(self, per_question: float, overhead: int = 60, margin: float = 1.3,
+                 limit: int = 8000, alpha: float = 0.2):
+        self.per_question = per_question
+        self.overhead = overhead    # обёртка {"questions": [...]} и текст вокруг JSON
+        self.margin = margin
+        self.limit = limit
+        self.alpha = alpha
+
+    def max_tokens(self, num_questions: int) -> int:
+        return min(self.limit, math.ceil(self.per_question * num_questions * self.margin + self.overhead))
+
+    def observe(self, result: Optional[Dict[str, Any]], questions: int):
+        usage = (result or {}).get('result', {}).get('usage') or {}
+        tokens = int(usage.get('completionTokens') or 0)
+        truncated = completion_alternative(result).get('status') == TRUNCATED
+        if not tokens or (questions == 0 and not truncated):
+            return
+        # Обёртка JSON входит в оценку, а в обрезанном ответе - и незаконченный
+        # вопрос: оценка получается с запасом
+        sample = tokens / max(questions, 1)
+        self.per_question += self.alpha * (sample - self.per_question)
+
+
+token_budget = TokenBudget(per_question=float(os.getenv('TEST_TOKENS_PER_QUESTION', '250')),
+                           limit=int(os.getenv('TEST_MAX_TOKENS', '8000')))
+
+
+async def request_completion(data: Dict[str, Any], api_key: str, folder_id: str,
+                             priority: int = INTERACTIVE, timeout: float = 60,
+                             operation: str = 'completion') -> Dict[str, Any]:
+    """Выполняет запрос к модели, выбранной маршрутизатором для operation."""
+    return await router.complete(operation, data, api_key, folder_id, priority=priority, timeout=timeout)
+
+
+async def stream_completion(data: Dict[str, Any], api_key: str, folder_id: str,
+                            on_text: Callable[[str], Awaitable[None]],
+                            priority: int = INTERACTIVE, timeout: float = 60,
+                            operation: str = 'completion_stream') -> Dict[str, Any]:
+    """
+    Потоковый запрос: текст, накопленный к каждому моменту, передаётся в
+    on_text. Возвращается последняя часть ответа - того же вида, что у
+    request_completion. На запасную модель переключается только запрос,
+    от которого ещё не пришло ни одной части.
+    """
+    return await router.stream(operation, data, api_key, folder_id, on_text, priority=priority, timeout=timeout)
+
+
+async def generate_hint(question: str, answer: str, api_key: str, folder_id: str,
+                        priority: int = INTERACTIVE) -> Optional[str]:
     prompt = f"""
     Сгенерируй пояснение для ученика, который ошибся в ответе на вопрос. 
     Не называй правильный ответ напрямую. Используй подсказки.
@@ -16,15 +86,7 @@ async def generate_hint(question: str, answer: str, api_key: str, folder_id: str
     - Предложи направление для размышлений
     """
 
-    url = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
-    headers = {
-        "Authorization": f"Api-Key {api_key}",
-        "x-folder-id": folder_id,
-        "Content-Type": "application/json"
-    }
-    
     data = {
-        "modelUri": f"gpt://{folder_id}/yandexgpt-lite",
         "completionOptions": {
             "stream": False,
             "temperature": 0.3,
@@ -36,9 +98,160 @@ async def generate_hint(question: str, answer: str, api_key: str, folder_id: str
         ]
     }
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, json=data) as response:
-            if response.status == 200:
-                result = await response.json()
-                return result['result']['alternatives'][0]['message']['text']
-            return None
\ No newline at end of file
+    try:
+        result = await request_completion(data, api_key, folder_id, priority=priority, operation='generate_hint')
+    except Exception as e:
+        print(f"API Error: {str(e)}")
+        return None
+    return result['result']['alternatives'][0]['message']['text']
+
+def build_test_request(topic: str, num_questions: int, difficulty: str, stream: bool = False,
+                       part: Optional[Tuple[int, int]] = None, avoid: Optional[List[str]] = None) -> Dict[str, Any]:
+    prompt = f"""
+    Сгенерируй тест по теме "{topic}". 
+    Количество вопросов: {num_questions}. Уровень сложности: {difficulty}.
+    Формат ответа: строго JSON с полем "questions" (список вопросов).
+    Каждый вопрос должен содержать:
+    - "question" (текст вопроса)
+    - "options" (список из 4 строк)
+    - "correct" (индекс правильного ответа: 0-3)
+    - "explanation" (краткое объяснение, почему этот ответ правильный)
+    """
+    if part is not None:
+        index, total = part
+        prompt += (f"\n    Это часть {index + 1} из {total} большого теста. Чтобы части не повторялись, "
+                   f"мысленно раздели тему на {total} разных аспектов и задавай вопросы только по аспекту №{index + 1}.\n")
+    if avoid:
+        prompt += "\n    Не повторяй эти вопросы и не задавай похожих:\n" + "\n".join(f"    - {q}" for q in avoid) + "\n"
+    return {
+        "completionOptions": {
+            "stream": stream,
+            "temperature": 0.7,  # Повышаем температуру для более разнообразных ответов
+            "maxTokens": token_budget.max_tokens(num_questions)
+        },
+        "messages": [
+            {
+                "role": "system",
+                "text": "Ты - опытный преподаватель и эксперт в создании учебных тестов. Твоя задача - создавать тесты по любой указанной теме."
+            },
+            {"role": "user", "text": prompt}
+        ]
+    }
+
+async def generate_test(topic: str, num_questions: int, difficulty: str, api_key: str, folder_id: str,
+                        part: Optional[Tuple[int, int]] = None, avoid: Optional[List[str]] = None,
+                        follow_up: bool = True) -> Optional[list]:
+    """
+    Генерирует тест одним запросом. Из обрезанного ответа сохраняются все
+    законченные вопросы, а недостающие запрашиваются ещё одним запросом.
+    """
+    data = build_test_request(topic, num_questions, difficulty, part=part, avoid=avoid)
+    try:
+        result = await request_completion(data, api_key, folder_id, timeout=40, operation='generate_test')
+    except Exception as e:
+        print(f"API Error: {str(e)}")
+        return None
+    validated = parse_questions(completion_text(result))[:num_questions]
+    token_budget.observe(result, len(validated))
+    if follow_up and len(validated) < num_questions and completion_alternative(result).get('status') == TRUNCATED:
+        print(f"Ответ обрезан: {len(validated)} из {num_questions} вопросов, дозапрашиваю остальные")
+        more = await generate_test(topic, num_questions - len(validated), difficulty, api_key, folder_id, part=part,
+                                   avoid=(avoid or []) + [q['question'] for q in validated], follow_up=False)
+        for question in more or []:
+            if not is_near_duplicate(question, validated):
+                validated.append(question)
+    if not validated:
+        print("Failed to parse JSON response")
+        return None
+    return validated
+
+async def generate_test_stream(topic: str, num_questions: int, difficulty: str, api_key: str, folder_id: str,
+                               on_question: Callable[[Dict[str, Any]], Awaitable[None]],
+                               part: Optional[Tuple[int, int]] = None, avoid: Optional[List[str]] = None,
+                               follow_up: bool = True) -> Optional[list]:
+    """
+    Потоковая генерация: вопросы разбираются из частичного ответа и
+    передаются в on_question, как только очередной вопрос полностью получен.
+    """
+    data = build_test_request(topic, num_questions, difficulty, stream=True, part=part, avoid=avoid)
+    parser = QuestionStreamParser()
+    validated = []
+
+    async def on_text(text: str):
+        for question in parser.feed(text):
+            if len(validated) >= num_questions:
+                return
+            validated.append(question)
+            await on_question(question)
+
+    try:
+        result = await stream_completion(data, api_key, folder_id, on_text, timeout=40,
+                                         operation='generate_test_stream')
+    except Exception as e:
+        print(f"API Error: {str(e)}")
+        # Уже полученные вопросы не выбрасываем
+        return validated or None
+    token_budget.observe(result, len(validated))
+    if follow_up and len(validated) < num_questions and completion_alternative(result).get('status') == TRUNCATED:
+        print(f"Ответ обрезан: {len(validated)} из {num_questions} вопросов, дозапрашиваю остальные")
+
+        async def accept(question):
+            if not is_near_duplicate(question, validated):
+                validated.append(question)
+                await on_question(question)
+
+        await generate_test_stream(topic, num_questions - len(validated), difficulty, api_key, folder_id, accept,
+                                   part=part, avoid=(avoid or []) + [q['question'] for q in validated],
+                                   follow_up=False)
+    return validated
+
+def split_into_shards(num_questions: int, shard_size: int) -> List[int]:
+    """Делит тест на почти равные части не больше shard_size вопросов."""
+    count = max(1, math.ceil(num_questions / shard_size))
+    base, extra = divmod(num_questions, count)
+    return [base + (1 if i < extra else 0) for i in range(count)]
+
+async def generate_test_sharded(topic: str, num_questions: int, difficulty: str, api_key: str, folder_id: str,
+                                on_question: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None,
+                                seed: Optional[List[Dict[str, Any]]] = None) -> Optional[list]:
+    """
+    Генерирует тест параллельными частями по TEST_SHARD_SIZE вопросов и
+    объединяет их, отбрасывая почти одинаковые вопросы. Если вопросов не
+    хватило, дозапрашивается только недостающее количество. С on_question
+    части генерируются потоково и вопросы передаются по мере готовности.
+    seed - вопросы, уже взятые в тест (например, из банка): генерируется
+    только остаток, и новые вопросы не должны их повторять.
+    """
+    accepted = list(seed or [])
+    if len(accepted) >= num_questions:
+        return accepted[:num_questions]
+
+    async def accept(question):
+        if len(accepted) >= num_questions or is_near_duplicate(question, accepted):
+            return
+        accepted.append(question)
+        if on_question is not None:
+            await on_question(question)
+
+    async def run_shard(size, part=None, avoid=None):
+        if on_question is not None:
+            await generate_test_stream(topic, size, difficulty, api_key, folder_id, accept, part=part, avoid=avoid)
+        else:
+            for question in await generate_test(topic, size, difficulty, api_key, folder_id,
+                                                part=part, avoid=avoid) or []:
+                await accept(question)
+
+    sizes = split_into_shards(num_questions - len(accepted), TEST_SHARD_SIZE)
+    avoid = [q['question'] for q in accepted] or None
+    await asyncio.gather(*(
+        run_shard(size, part=(i, len(sizes)) if len(sizes) > 1 else None, avoid=avoid)
+        for i, size in enumerate(sizes)
+    ))
+    for _ in range(TOPUP_ROUNDS):
+        shortfall = num_questions - len(accepted)
+        # Ничего не сгенерировано - API недоступен, повторять нет смысла
+        if shortfall <= 0 or len(accepted) == len(seed or []):
+            break
+        print(f"Не хватает вопросов: {shortfall}, дозапрашиваю")
+        await run_shard(shortfall, avoid=[q['question'] for q in accepted])
+    return accepted or None